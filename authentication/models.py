@@ -25,7 +25,7 @@ class AuthServicesInfo(models.Model):
     market_password = models.CharField(max_length=254, blank=True, default="")
     pathfinder_username = models.CharField(max_length=254, blank=True, default="")
     pathfinder_password = models.CharField(max_length=254, blank=True, default="")
-    main_char_id = models.CharField(max_length=64, blank=True, default="")
+    main_char_id = models.CharField(max_length=64, blank=True, default="", db_index=True)
     is_blue = models.BooleanField(default=False)
     user = models.ForeignKey(User)
 
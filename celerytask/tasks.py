@@ -1,4 +1,7 @@
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db import transaction
 from celery.task import periodic_task
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
@@ -13,6 +16,8 @@ from services.managers.teamspeak3_manager import Teamspeak3Manager
 from services.managers.discord_manager import DiscordManager, DiscordAPIManager
 from services.managers.discourse_manager import DiscourseManager
 from services.managers.smf_manager import smfManager
+from services.managers.pathfinder_manager import pathfinderManager
+from services.managers.util.db import format_query_stats
 from services.models import AuthTS
 from services.models import TSgroup
 from authentication.models import AuthServicesInfo
@@ -22,6 +27,7 @@ from util.common_task import deactivate_services
 from util import add_member_permission
 from util import remove_member_permission
 from util import check_if_user_has_permission
+from util import get_permission
 from util.common_task import add_user_to_group
 from util.common_task import remove_user_from_group
 from util.common_task import generate_corp_group_name
@@ -31,10 +37,12 @@ from eveonline.models import EveCorporationInfo
 from eveonline.models import EveAllianceInfo
 from authentication.managers import AuthServicesInfoManager
 from services.models import DiscordAuthToken
+from celerytask.models import SyncGroupCache
 
 import evelink
 import time
 import logging
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +63,32 @@ def disable_member(user):
 def is_teamspeak3_active():
     return settings.ENABLE_AUTH_TEAMSPEAK3 or settings.ENABLE_BLUE_TEAMSPEAK3
 
+def get_sync_group_names(usergroups):
+    groups = []
+    for group in usergroups:
+        groups.append(str(group.name))
+    if len(groups) == 0:
+        groups.append('empty')
+    return groups
+
+def get_teamspeak3_groups(usergroups):
+    groups = {}
+    for filtered_group in AuthTS.objects.filter(auth_group__in=usergroups).prefetch_related('ts_group'):
+        for ts_group in filtered_group.ts_group.all():
+            groups[ts_group.ts_group_name] = ts_group.ts_group_id
+    return groups
+
+def get_sync_group_cache(user):
+    snapshot = {}
+    for servicename, groupname in SyncGroupCache.objects.filter(user=user).values_list('servicename', 'groupname'):
+        snapshot.setdefault(servicename, set()).add(groupname)
+    return snapshot
+
+def update_sync_group_cache(user, servicename, groups):
+    logger.debug("Recording pushed %s groups for user %s: %s" % (servicename, user, groups))
+    SyncGroupCache.objects.filter(user=user, servicename=servicename).delete()
+    SyncGroupCache.objects.bulk_create([SyncGroupCache(user=user, servicename=servicename, groupname=group) for group in set(groups)])
+
 @task
 def update_jabber_groups(pk):
     user = User.objects.get(pk=pk)
@@ -68,6 +102,7 @@ def update_jabber_groups(pk):
     logger.debug("Updating user %s jabber groups to %s" % (user, groups))
     try:
         OpenfireManager.update_user_groups(authserviceinfo.jabber_username, authserviceinfo.jabber_password, groups)
+        update_sync_group_cache(user, "jabber", groups)
     except:
         logger.exception("Jabber group sync failed for %s, retrying in 10 mins" % user)
         raise self.retry(countdown = 60 * 10)
@@ -86,6 +121,7 @@ def update_mumble_groups(pk):
     logger.debug("Updating user %s mumble groups to %s" % (user, groups))
     try:
         MumbleManager.update_groups(authserviceinfo.mumble_username, groups)
+        update_sync_group_cache(user, "mumble", groups)
     except:
         logger.exception("Mumble group sync failed for %s, retrying in 10 mins" % user)
         raise self.retry(countdown = 60 * 10)
@@ -104,11 +140,60 @@ def update_forum_groups(pk):
     logger.debug("Updating user %s forum groups to %s" % (user, groups))
     try:
         Phpbb3Manager.update_groups(authserviceinfo.forum_username, groups)
+        update_sync_group_cache(user, "forum", groups)
     except:
         logger.exception("Phpbb group sync failed for %s, retrying in 10 mins" % user)
         raise self.retry(countdown = 60 * 10)
     logger.debug("Updated user %s forum groups." % user)
 
+def get_bulk_sync_groups(field):
+    # AuthServicesInfo field value -> (user pk, group names) for every user with that service
+    accounts = dict(AuthServicesInfo.objects.exclude(**{field: ""}).values_list('user_id', field))
+    groups = dict((user_id, []) for user_id in accounts)
+    for user_id, groupname in User.groups.through.objects.filter(user_id__in=accounts.keys()).values_list('user_id', 'group__name'):
+        groups[user_id].append(str(groupname))
+    return dict((account, (user_id, groups[user_id] or ['empty'])) for user_id, account in accounts.items())
+
+# Run every night
+@periodic_task(run_every=crontab(minute="0", hour="4"))
+def run_forum_group_resync():
+    if not (settings.ENABLE_AUTH_FORUM or settings.ENABLE_BLUE_FORUM):
+        return
+    logger.debug("Resyncing phpbb groups for all forum users")
+    accounts = get_bulk_sync_groups('forum_username')
+    changed = Phpbb3Manager.update_groups_bulk(dict((account, groups) for account, (user_id, groups) in accounts.items()))
+    changed_groups = dict(accounts[account] for account in changed)
+    for user in User.objects.filter(pk__in=changed_groups.keys()):
+        update_sync_group_cache(user, "forum", changed_groups[user.pk])
+    logger.info("Resynced phpbb groups for %s forum users, %s changed." % (len(accounts), len(changed)))
+    logger.info("phpbb3 database since worker start: %s" % format_query_stats('phpbb3'))
+
+# Run every night
+@periodic_task(run_every=crontab(minute="30", hour="4"))
+def run_smf_group_resync():
+    if not (settings.ENABLE_AUTH_SMF or settings.ENABLE_BLUE_SMF):
+        return
+    logger.debug("Resyncing smf groups for all smf users")
+    accounts = get_bulk_sync_groups('smf_username')
+    changed = smfManager.update_groups_bulk(dict((account, groups) for account, (user_id, groups) in accounts.items()))
+    changed_groups = dict(accounts[account] for account in changed)
+    for user in User.objects.filter(pk__in=changed_groups.keys()):
+        update_sync_group_cache(user, "smf", changed_groups[user.pk])
+    logger.info("Resynced smf groups for %s smf users, %s changed." % (len(accounts), len(changed)))
+    logger.info("smf database since worker start: %s" % format_query_stats('smf'))
+
+# Run after each api refresh
+@periodic_task(run_every=crontab(minute="30", hour="*/3"))
+def run_pathfinder_character_resync():
+    if not (settings.ENABLE_AUTH_PATHFINDER or settings.ENABLE_BLUE_PATHFINDER):
+        return
+    logger.debug("Resyncing pathfinder characters for all pathfinder users")
+    accounts = dict((username, (user_id, main_char_id)) for user_id, username, main_char_id in
+                    AuthServicesInfo.objects.exclude(pathfinder_username="").values_list('user_id', 'pathfinder_username', 'main_char_id'))
+    changed = pathfinderManager.resync_characters(accounts)
+    logger.info("Resynced pathfinder characters for %s pathfinder users, %s changed." % (len(accounts), len(changed)))
+    logger.info("pathfinder database since worker start: %s" % format_query_stats('pathfinder'))
+
 @task
 def update_smf_groups(pk):
     user = User.objects.get(pk=pk)
@@ -122,6 +207,7 @@ def update_smf_groups(pk):
     logger.debug("Updating user %s smf groups to %s" % (user, groups))
     try:
         smfManager.update_groups(authserviceinfo.smf_username, groups)
+        update_sync_group_cache(user, "smf", groups)
     except:
         logger.exception("smf group sync failed for %s, retrying in 10 mins" % user)
         raise self.retry(countdown = 60 * 10)
@@ -141,6 +227,7 @@ def update_ipboard_groups(pk):
     logger.debug("Updating user %s ipboard groups to %s" % (user, groups))
     try:
         IPBoardManager.update_groups(authserviceinfo.ipboard_username, groups)
+        update_sync_group_cache(user, "ipboard", groups)
     except:
         logger.exception("IPBoard group sync failed for %s, retrying in 10 mins" % user)
         raise self.retry(countdown = 60 * 10)
@@ -150,18 +237,47 @@ def update_ipboard_groups(pk):
 def update_teamspeak3_groups(pk):
     user = User.objects.get(pk=pk)
     logger.debug("Updating user %s teamspeak3 groups" % user)
-    usergroups = user.groups.all()
     authserviceinfo = AuthServicesInfo.objects.get(user=user)
-    groups = {}
-    for usergroup in usergroups:
-        filtered_groups = AuthTS.objects.filter(auth_group=usergroup)
-        if filtered_groups:
-            for filtered_group in filtered_groups:
-                for ts_group in filtered_group.ts_group.all():
-                    groups[ts_group.ts_group_name] = ts_group.ts_group_id
+    groups = get_teamspeak3_groups(user.groups.all())
     logger.debug("Updating user %s teamspeak3 groups to %s" % (user, groups))
-    Teamspeak3Manager.update_groups(authserviceinfo.teamspeak3_uid, groups)
-    logger.debug("Updated user %s teamspeak3 groups." % user)
+    if Teamspeak3Manager.update_groups(authserviceinfo.teamspeak3_uid, groups):
+        # only remember what the server actually holds, so the next sync retries otherwise
+        update_sync_group_cache(user, "teamspeak3", groups.keys() or ['empty'])
+        logger.debug("Updated user %s teamspeak3 groups." % user)
+    else:
+        logger.warn("Teamspeak3 groups for user %s were not fully applied." % user)
+
+TEAMSPEAK3_RECONCILE_PENDING_KEY = "teamspeak3_reconcile_pending"
+
+def queue_teamspeak3_reconcile():
+    # AuthTS edits fire several signals, coalesce them into one reconcile
+    if not settings.GROUP_SYNC_DEBOUNCE:
+        reconcile_teamspeak3_groups.delay()
+    elif cache.add(TEAMSPEAK3_RECONCILE_PENDING_KEY, True, settings.GROUP_SYNC_DEBOUNCE):
+        logger.debug("Scheduling teamspeak3 reconcile in %s seconds" % settings.GROUP_SYNC_DEBOUNCE)
+        reconcile_teamspeak3_groups.apply_async(countdown=settings.GROUP_SYNC_DEBOUNCE)
+    else:
+        logger.debug("Teamspeak3 reconcile already pending. Coalescing.")
+
+@task
+def reconcile_teamspeak3_groups():
+    start = time.time()
+    logger.debug("Reconciling teamspeak3 groups for all users")
+    mapping = {}
+    for group_id, ts_group_id, ts_group_name in AuthTS.ts_group.through.objects.values_list(
+            'authts__auth_group_id', 'tsgroup_id', 'tsgroup__ts_group_name'):
+        mapping.setdefault(group_id, {})[ts_group_name] = ts_group_id
+    ts_uids = dict(AuthServicesInfo.objects.exclude(teamspeak3_uid="").values_list('user_id', 'teamspeak3_uid'))
+    user_ts_groups = dict((user_id, {}) for user_id in ts_uids)
+    for user_id, group_id in User.groups.through.objects.filter(user_id__in=ts_uids.keys()).values_list('user_id', 'group_id'):
+        user_ts_groups[user_id].update(mapping.get(group_id, {}))
+    expected = dict((ts_uids[user_id], groups.values()) for user_id, groups in user_ts_groups.items())
+    changed = set(Teamspeak3Manager.reconcile_groups(expected))
+    changed_users = [user_id for user_id, uid in ts_uids.items() if uid in changed]
+    for user in User.objects.filter(pk__in=changed_users):
+        update_sync_group_cache(user, "teamspeak3", user_ts_groups[user.pk].keys() or ['empty'])
+    logger.info("Reconciled teamspeak3 groups for %s users in %.1fs, %s changed." % (
+        len(ts_uids), time.time() - start, len(changed_users)))
 
 @task
 def update_discord_groups(pk):
@@ -177,6 +293,7 @@ def update_discord_groups(pk):
     logger.debug("Updating user %s discord groups to %s" % (user, groups))
     try:
         DiscordManager.update_groups(authserviceinfo.discord_uid, groups)
+        update_sync_group_cache(user, "discord", groups)
     except:
         logger.exception("Discord group sync failed for %s, retrying in 10 mins" % user)
         raise self.retry(countdown = 60 * 10)
@@ -196,11 +313,102 @@ def update_discourse_groups(pk):
     logger.debug("Updating user %s discord groups to %s" % (user, groups))
     try:
         DiscourseManager.update_groups(authserviceinfo.discourse_username, groups)
+        update_sync_group_cache(user, "discourse", groups)
     except:
         logger.warn("Discourse group sync failed for %s, retrying in 10 mins" % user, exc_info=True)
         raise self.retry(countdown = 60 * 10)
     logger.debug("Updated user %s discord groups." % user)
 
+# servicename, AuthServicesInfo account field, per-service sync task
+SYNC_GROUP_SERVICES = (
+    ("jabber", "jabber_username", update_jabber_groups),
+    ("teamspeak3", "teamspeak3_uid", update_teamspeak3_groups),
+    ("forum", "forum_username", update_forum_groups),
+    ("smf", "smf_username", update_smf_groups),
+    ("ipboard", "ipboard_username", update_ipboard_groups),
+    ("discord", "discord_uid", update_discord_groups),
+    ("mumble", "mumble_username", update_mumble_groups),
+    ("discourse", "discourse_username", update_discourse_groups),
+)
+
+# queries each per-service task spends loading user, authserviceinfo and groups
+SYNC_GROUP_TASK_QUERIES = 3
+
+GROUP_SYNC_PENDING_KEY = "group_sync_pending_%s"
+# queued and suppressed are counted where the sync is queued, flushed in the celery worker,
+# so the counters only add up when CACHES points at a backend shared by both
+GROUP_SYNC_STATS = ("queued", "flushed", "suppressed")
+
+# the counters never expire, queue depth is the difference of two of them
+GROUP_SYNC_STATS_TIMEOUT = None
+
+def incr_group_sync_stat(name, delta=1):
+    key = "group_sync_stat_%s" % name
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, GROUP_SYNC_STATS_TIMEOUT):
+            cache.incr(key, delta)
+
+def get_group_sync_stats():
+    stats = cache.get_many(["group_sync_stat_%s" % name for name in GROUP_SYNC_STATS])
+    stats = dict((name, stats.get("group_sync_stat_%s" % name, 0)) for name in GROUP_SYNC_STATS)
+    # debounced syncs waiting for their countdown or a free worker
+    stats["queue_depth"] = max(stats["queued"] - stats["flushed"], 0)
+    return stats
+
+def queue_group_update(pk):
+    # The pending marker lives exactly as long as the flush countdown, so any
+    # edit suppressed by it lands before the scheduled flush reads the groups.
+    if not settings.GROUP_SYNC_DEBOUNCE:
+        update_groups.delay(pk)
+        return
+    if cache.add(GROUP_SYNC_PENDING_KEY % pk, True, settings.GROUP_SYNC_DEBOUNCE):
+        logger.debug("Scheduling group sync for user pk %s in %s seconds" % (pk, settings.GROUP_SYNC_DEBOUNCE))
+        incr_group_sync_stat("queued")
+        update_groups.apply_async(args=[pk], countdown=settings.GROUP_SYNC_DEBOUNCE)
+    else:
+        logger.debug("Group sync for user pk %s already pending. Coalescing." % pk)
+        incr_group_sync_stat("suppressed")
+
+@task
+def update_groups(pk):
+    if settings.GROUP_SYNC_DEBOUNCE:
+        incr_group_sync_stat("flushed")
+    user = User.objects.get(pk=pk)
+    logger.debug("Determining service group changes for user %s" % user)
+    auth, c = AuthServicesInfo.objects.get_or_create(user=user)
+    usergroups = list(user.groups.all())
+    snapshot = get_sync_group_cache(user)
+    groups = set(get_sync_group_names(usergroups))
+    ts_groups = None
+    dispatched = 0
+    skipped = 0
+    for servicename, field, sync_task in SYNC_GROUP_SERVICES:
+        if not getattr(auth, field):
+            continue
+        if servicename == "teamspeak3":
+            if ts_groups is None:
+                ts_groups = set(get_teamspeak3_groups(usergroups).keys() or ['empty'])
+            desired = ts_groups
+        else:
+            desired = groups
+        if snapshot.get(servicename) == desired:
+            logger.debug("User %s %s groups unchanged. Skipping sync." % (user, servicename))
+            skipped += 1
+        else:
+            logger.debug("User %s %s groups changed. Triggering sync." % (user, servicename))
+            sync_task.delay(pk)
+            dispatched += 1
+    logger.info("Group sync for user %s dispatched %s service tasks, skipped %s unchanged (saved %s tasks, ~%s queries)." % (
+        user, dispatched, skipped, skipped, skipped * SYNC_GROUP_TASK_QUERIES))
+
+# Run every 30 minutes
+@periodic_task(run_every=crontab(minute="*/30"))
+def run_group_sync_stats():
+    if settings.GROUP_SYNC_DEBOUNCE:
+        logger.info("Group sync queue stats: %s" % get_group_sync_stats())
+
 
 def assign_corp_group(auth):
     corp_group = None
@@ -294,7 +502,7 @@ def make_blue(user):
     # ensure user is not a member
     if check_if_user_has_permission(user, 'member'):
         logger.info("Removing user %s member permission to transition to blue" % user)
-        remove_member_permission(user, 'blue_member')
+        remove_member_permission(user, 'member')
         change = True
     member_group, c = Group.objects.get_or_create(name=settings.DEFAULT_AUTH_GROUP)
     if member_group in user.groups.all():
@@ -321,7 +529,7 @@ def make_blue(user):
     assign_alliance_group(auth)
     return change
 
-def determine_membership_by_character(char):
+def determine_membership_by_character(char, corps=None):
     if settings.IS_CORP:
         if char.corporation_id == settings.CORP_ID:
             logger.debug("Character %s in owning corp id %s" % (char, char.corporation_id))
@@ -330,11 +538,17 @@ def determine_membership_by_character(char):
         if char.alliance_id == settings.ALLIANCE_ID:
             logger.debug("Character %s in owning alliance id %s" % (char, char.alliance_id))
             return "MEMBER"
-    if EveCorporationInfo.objects.filter(corporation_id=char.corporation_id).exists() is False:
+    if corps is not None:
+        # preloaded corp models keyed by corporation_id
+        corp = corps.get(char.corporation_id)
+    elif EveCorporationInfo.objects.filter(corporation_id=char.corporation_id).exists():
+        corp = EveCorporationInfo.objects.get(corporation_id=char.corporation_id)
+    else:
+        corp = None
+    if corp is None:
          logger.debug("No corp model for character %s corp id %s. Unable to check standings. Non-member." % (char, char.corporation_id))
          return False
     else:
-         corp = EveCorporationInfo.objects.get(corporation_id=char.corporation_id)
          if corp.is_blue:
              logger.debug("Character %s member of blue corp %s" % (char, corp))
              return "BLUE"
@@ -371,6 +585,170 @@ def set_state(user):
     if change:
         notify(user, "Membership State Change", message="You membership state has been changed to %s" % state)
 
+def has_active_services(auth):
+    return bool(auth.mumble_username or auth.jabber_username or auth.forum_username or auth.ipboard_username or
+                auth.teamspeak3_uid or auth.discord_uid)
+
+# users per recompute_states chunk, keeps every IN clause under SQLite's 999 variable limit
+STATE_RECOMPUTE_CHUNK = 250
+
+# Bulk equivalent of set_state: loads mains, corps, permissions and groups in a
+# handful of queries, classifies users in memory and writes only the deltas.
+# Users are processed in chunks so a failure only affects the users of its chunk.
+def recompute_states(user_ids):
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), STATE_RECOMPUTE_CHUNK):
+        chunk = user_ids[i:i + STATE_RECOMPUTE_CHUNK]
+        try:
+            recompute_state_chunk(chunk)
+        except:
+            logger.exception("Failed to recompute membership state for users %s" % chunk)
+
+# Writing the through tables directly skips m2m_changed, so group syncs are
+# queued explicitly for users whose groups changed.
+def recompute_state_chunk(user_ids):
+    start = time.time()
+    users = dict((user.pk, user) for user in User.objects.filter(pk__in=user_ids, is_superuser=False))
+    if not users:
+        return
+    auths = dict((auth.user_id, auth) for auth in AuthServicesInfo.objects.filter(user__in=users.keys()))
+    for pk in users:
+        if pk not in auths:
+            auths[pk], c = AuthServicesInfo.objects.get_or_create(user=users[pk])
+    chars = dict((char.character_id, char) for char in
+                 EveCharacter.objects.filter(character_id__in=[auth.main_char_id for auth in auths.values() if auth.main_char_id]))
+    corps = dict((corp.corporation_id, corp) for corp in
+                 EveCorporationInfo.objects.filter(corporation_id__in=set(char.corporation_id for char in chars.values())))
+
+    UserPermission = User.user_permissions.through
+    UserGroup = User.groups.through
+    user_perms = {}
+    for row_id, user_id, perm_id in UserPermission.objects.filter(user__in=users.keys()).values_list('id', 'user_id', 'permission_id'):
+        user_perms.setdefault(user_id, {})[perm_id] = row_id
+    user_groups = {}
+    for row_id, user_id, group_id, name in UserGroup.objects.filter(user__in=users.keys()).values_list('id', 'user_id', 'group_id', 'group__name'):
+        user_groups.setdefault(user_id, {})[group_id] = (row_id, name)
+
+    member_perm = get_permission("member")
+    blue_perm = get_permission("blue_member")
+    member_group, c = Group.objects.get_or_create(name=settings.DEFAULT_AUTH_GROUP)
+    blue_group, c = Group.objects.get_or_create(name=settings.DEFAULT_BLUE_GROUP)
+
+    # classify and work out which corp/alliance groups are wanted
+    states = {}
+    wanted = {}
+    for pk, user in users.items():
+        auth = auths[pk]
+        char = chars.get(auth.main_char_id) if auth.main_char_id else None
+        state = determine_membership_by_character(char, corps=corps) if char else False
+        states[pk] = state
+        names = []
+        if state == "MEMBER" or state == "BLUE":
+            if (state == "MEMBER" and settings.MEMBER_CORP_GROUPS) or (state == "BLUE" and settings.BLUE_CORP_GROUPS):
+                names.append(generate_corp_group_name(char.corporation_name))
+            if char.alliance_name and ((state == "MEMBER" and settings.MEMBER_ALLIANCE_GROUPS) or
+                                       (state == "BLUE" and settings.BLUE_ALLIANCE_GROUPS)):
+                names.append(generate_alliance_group_name(char.alliance_name))
+        wanted[pk] = names
+    groups_by_name = dict((group.name, group) for group in
+                          Group.objects.filter(name__in=set(name for names in wanted.values() for name in names)))
+    for names in wanted.values():
+        for name in names:
+            if name not in groups_by_name:
+                groups_by_name[name], c = Group.objects.get_or_create(name=name)
+
+    add_perms = []
+    remove_perms = []
+    add_groups = []
+    remove_groups = []
+    mark_blue = []
+    mark_not_blue = []
+    disable = []
+    changed = {}
+    groups_changed = set()
+    for pk, user in users.items():
+        state = states[pk]
+        auth = auths[pk]
+        perms = user_perms.get(pk, {})
+        groups = user_groups.get(pk, {})
+        logger.debug("Assigning user %s to state %s" % (user, state))
+        if state != "MEMBER" and state != "BLUE":
+            if perms or groups or has_active_services(auth):
+                # disabled once the chunk is written, deactivating services can't be rolled back
+                disable.append(user)
+                if perms or groups:
+                    changed[pk] = state
+            continue
+        if state == "MEMBER":
+            keep_perm, drop_perm, keep_group, drop_group = member_perm, blue_perm, member_group, blue_group
+        else:
+            keep_perm, drop_perm, keep_group, drop_group = blue_perm, member_perm, blue_group, member_group
+        if drop_perm.pk in perms:
+            logger.info("Removing user %s %s permission" % (user, drop_perm.codename))
+            remove_perms.append(perms[drop_perm.pk])
+            changed[pk] = state
+        if keep_perm.pk not in perms:
+            logger.info("Adding user %s %s permission" % (user, keep_perm.codename))
+            add_perms.append(UserPermission(user_id=pk, permission_id=keep_perm.pk))
+            changed[pk] = state
+        if drop_group.pk in groups:
+            logger.info("Removing user %s from group %s" % (user, drop_group))
+            remove_groups.append(groups[drop_group.pk][0])
+            changed[pk] = state
+            groups_changed.add(pk)
+        if keep_group.pk not in groups:
+            logger.info("Adding user %s to group %s" % (user, keep_group))
+            add_groups.append(UserGroup(user_id=pk, group_id=keep_group.pk))
+            changed[pk] = state
+            groups_changed.add(pk)
+        wanted_ids = set()
+        for name in wanted[pk]:
+            group_id = groups_by_name[name].pk
+            wanted_ids.add(group_id)
+            if group_id not in groups:
+                logger.info("Adding user %s to group %s" % (user, name))
+                add_groups.append(UserGroup(user_id=pk, group_id=group_id))
+                groups_changed.add(pk)
+        for group_id, (row_id, name) in groups.items():
+            if (name.startswith("Corp_") or name.startswith("Alliance_")) and group_id not in wanted_ids:
+                logger.info("Removing user %s from old group %s" % (user, name))
+                remove_groups.append(row_id)
+                groups_changed.add(pk)
+        if state == "BLUE" and not auth.is_blue:
+            logger.info("Marking user %s as blue" % user)
+            mark_blue.append(auth.pk)
+            changed[pk] = state
+        elif state == "MEMBER" and auth.is_blue:
+            logger.info("Marking user %s as non-blue" % user)
+            mark_not_blue.append(auth.pk)
+            changed[pk] = state
+
+    # all or nothing per chunk, syncs and notifications only go out once the rows are committed
+    with transaction.atomic():
+        if remove_perms:
+            UserPermission.objects.filter(id__in=remove_perms).delete()
+        if add_perms:
+            UserPermission.objects.bulk_create(add_perms)
+        if remove_groups:
+            UserGroup.objects.filter(id__in=remove_groups).delete()
+        if add_groups:
+            UserGroup.objects.bulk_create(add_groups)
+        if mark_blue:
+            AuthServicesInfo.objects.filter(pk__in=mark_blue).update(is_blue=True)
+        if mark_not_blue:
+            AuthServicesInfo.objects.filter(pk__in=mark_not_blue).update(is_blue=False)
+    for user in disable:
+        try:
+            disable_member(user)
+        except:
+            logger.exception("Failed to disable user %s" % user)
+    for pk in groups_changed:
+        queue_group_update(pk)
+    for pk, state in changed.items():
+        notify(users[pk], "Membership State Change", message="You membership state has been changed to %s" % state)
+    logger.info("Recomputed membership state for %s users in %.1fs: %s changed, %s permission and %s group rows written." % (
+        len(users), time.time() - start, len(changed), len(add_perms) + len(remove_perms), len(add_groups) + len(remove_groups)))
+
 # Run every 2 hours
 @periodic_task(run_every=crontab(minute="0", hour="*/2"))
 def run_discord_token_cleanup():
@@ -383,6 +761,26 @@ def run_discord_token_cleanup():
             logger.debug("DiscordAuthToken failed validation. Deleting %s" % auth)
             auth.delete()
 
+# Run every 4 hours
+@periodic_task(run_every=crontab(minute="30", hour="*/4"))
+def run_discord_reconcile():
+    if not (settings.ENABLE_AUTH_DISCORD or settings.ENABLE_BLUE_DISCORD):
+        return
+    logger.debug("Reconciling discord server members with auth groups")
+    discord_uids = dict(AuthServicesInfo.objects.exclude(discord_uid="").values_list('user_id', 'discord_uid'))
+    user_groups = {}
+    for user_id, groupname in User.groups.through.objects.filter(user_id__in=discord_uids.keys()).values_list('user_id', 'group__name'):
+        user_groups.setdefault(user_id, []).append(str(groupname))
+    expected = {}
+    for user_id, discord_uid in discord_uids.items():
+        expected[str(discord_uid)] = user_groups.get(user_id) or ['empty']
+    changed, kicked = DiscordManager.reconcile_members(expected)
+    changed_users = [user_id for user_id, discord_uid in discord_uids.items() if str(discord_uid) in changed]
+    for user in User.objects.filter(pk__in=changed_users):
+        update_sync_group_cache(user, "discord", expected[str(discord_uids[user.pk])])
+    logger.info("Discord reconcile updated %s members, kicked %s. Rate limit stats: %s" % (
+        len(changed), len(kicked), DiscordAPIManager.get_rate_limit_stats()))
+
 def refresh_api(api_key_pair):
     logger.debug("Running update on api key %s" % api_key_pair.api_id)
     user = api_key_pair.user
@@ -436,21 +834,18 @@ def refresh_api(api_key_pair):
         EveManager.delete_api_key_pair(api_key_pair.api_id, user.id)
         notify(user, "API Key Deleted", message="Your API key ID %s is invalid. It and its associated characters have been deleted." % api_key_pair.api_id, level="danger")
 
-# Run every 3 hours
-@periodic_task(run_every=crontab(minute=0, hour="*/3"))
-def run_api_refresh():
-    users = User.objects.all()
-    logger.debug("Running api refresh on %s users." % len(users))
-    for user in users:
-        # Check if the api server is online
-        logger.debug("Running api refresh for user %s" % user)
-        if EveApiManager.check_if_api_server_online():
+def refresh_user_apis(user, api_server_online=True):
+    logger.debug("Running api refresh for user %s" % user)
+    key_count = 0
+    try:
+        if api_server_online:
             api_key_pairs = EveManager.get_api_key_pairs(user.id)
             logger.debug("User %s has api key pairs %s" % (user, api_key_pairs))
             if api_key_pairs:
                 authserviceinfo, c = AuthServicesInfo.objects.get_or_create(user=user)
                 logger.debug("User %s has api keys. Proceeding to refresh." % user)
                 for api_key_pair in api_key_pairs:
+                    key_count += 1
                     try:
                         refresh_api(api_key_pair)
                     except evelink.api.APIError as e:
@@ -469,7 +864,33 @@ def run_api_refresh():
                     authserviceinfo.main_char_id = ''
                     authserviceinfo.save()
                     notify(user, "Main Character Reset", message="Your specified main character no longer has a model.\nThis could be the result of an invalid API\nYour main character ID has been reset.", level="warn")
-        set_state(user)
+    except:
+        logger.exception("Api refresh failed for user %s" % user)
+    finally:
+        # worker threads hold their own connection; don't leak it between runs
+        connection.close()
+    return key_count
+
+# Run every 3 hours
+@periodic_task(run_every=crontab(minute=0, hour="*/3"))
+def run_api_refresh():
+    users = User.objects.all()
+    logger.debug("Running api refresh on %s users." % len(users))
+    # Check if the api server is online
+    api_server_online = EveApiManager.check_if_api_server_online()
+    start = time.time()
+    pool = ThreadPool(max(int(settings.API_REFRESH_CONCURRENCY), 1))
+    try:
+        key_counts = pool.map(lambda user: refresh_user_apis(user, api_server_online), users)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    keys = sum(key_counts)
+    logger.info("Api refresh of %s keys for %s users completed in %.1fs (%.2f keys/s, concurrency %s)." % (
+        keys, len(users), elapsed, keys / elapsed if elapsed else 0, settings.API_REFRESH_CONCURRENCY))
+    logger.info("EVE API cache after api refresh: %s" % EveApiManager.get_api_cache_stats())
+    recompute_states([user.pk for user in users])
 
 def populate_alliance(id, blue=False):
     logger.debug("Populating alliance model with id %s blue %s" % (id, blue))
@@ -713,6 +1134,7 @@ def run_corp_update():
                     logger.debug("Corp %s is owning corp" % corp)
     except evelink.api.APIError as e:
         logger.error("Model update failed with error code %s" % e.code)
+    logger.info("EVE API cache after corp update: %s" % EveApiManager.get_api_cache_stats())
 
 @periodic_task(run_every=crontab(minute="*/30"))
 def run_ts3_group_update():
@@ -4,14 +4,34 @@ from models import EveAllianceInfo
 from models import EveCorporationInfo
 
 from services.managers.eve_api_manager import EveApiManager
+from django.core.cache import cache
 import logging
 
 logger = logging.getLogger(__name__)
 
 class EveManager:
+    # seconds a resolved corp ticker is reused before checking again
+    CORP_TICKER_CACHE_TIMEOUT = 60 * 60 * 6
+
     def __init__(self):
         pass
 
+    @staticmethod
+    def get_corporation_ticker(corp_id):
+        key = "corp_ticker_%s" % corp_id
+        ticker = cache.get(key)
+        if ticker is not None:
+            logger.debug("Using cached ticker %s for corp id %s" % (ticker, corp_id))
+            return ticker
+        corp_info = EveCorporationInfo.objects.filter(corporation_id=corp_id).values_list('corporation_ticker', flat=True)
+        if corp_info:
+            ticker = corp_info[0]
+            logger.debug("Using corp model ticker %s for corp id %s" % (ticker, corp_id))
+        else:
+            ticker = EveApiManager.get_corporation_ticker_from_id(corp_id)
+        cache.set(key, ticker, EveManager.CORP_TICKER_CACHE_TIMEOUT)
+        return ticker
+
     @staticmethod
     def create_character(character_id, character_name, corporation_id,
                          corporation_name, corporation_ticker, alliance_id,
@@ -42,7 +62,7 @@ class EveManager:
                                             chars.result[char]['name'],
                                             chars.result[char]['corp']['id'],
                                             chars.result[char]['corp']['name'],
-                                            EveApiManager.get_corporation_ticker_from_id(
+                                            EveManager.get_corporation_ticker(
                                                 chars.result[char]['corp']['id']),
                                             chars.result[char]['alliance']['id'],
                                             chars.result[char]['alliance']['name'],
@@ -57,7 +77,7 @@ class EveManager:
                 logger.debug("Got existing character model %s" % eve_char)
                 eve_char.corporation_id = chars.result[char]['corp']['id']
                 eve_char.corporation_name = chars.result[char]['corp']['name']
-                eve_char.corporation_ticker = EveApiManager.get_corporation_ticker_from_id(
+                eve_char.corporation_ticker = EveManager.get_corporation_ticker(
                     chars.result[char]['corp']['id'])
                 eve_char.alliance_id = chars.result[char]['alliance']['id']
                 eve_char.alliance_name = chars.result[char]['alliance']['name']
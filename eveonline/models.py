@@ -3,14 +3,14 @@ from django.contrib.auth.models import User
 
 
 class EveCharacter(models.Model):
-    character_id = models.CharField(max_length=254)
+    character_id = models.CharField(max_length=254, db_index=True)
     character_name = models.CharField(max_length=254)
-    corporation_id = models.CharField(max_length=254)
+    corporation_id = models.CharField(max_length=254, db_index=True)
     corporation_name = models.CharField(max_length=254)
     corporation_ticker = models.CharField(max_length=254)
-    alliance_id = models.CharField(max_length=254)
+    alliance_id = models.CharField(max_length=254, db_index=True)
     alliance_name = models.CharField(max_length=254)
-    api_id = models.CharField(max_length=254)
+    api_id = models.CharField(max_length=254, db_index=True)
     user = models.ForeignKey(User)
 
     def __str__(self):
@@ -18,7 +18,7 @@ class EveCharacter(models.Model):
 
 
 class EveApiKeyPair(models.Model):
-    api_id = models.CharField(max_length=254)
+    api_id = models.CharField(max_length=254, db_index=True)
     api_key = models.CharField(max_length=254)
     user = models.ForeignKey(User)
     error_count = models.PositiveIntegerField(default=0)
@@ -28,7 +28,7 @@ class EveApiKeyPair(models.Model):
 
 
 class EveAllianceInfo(models.Model):
-    alliance_id = models.CharField(max_length=254)
+    alliance_id = models.CharField(max_length=254, db_index=True)
     alliance_name = models.CharField(max_length=254)
     alliance_ticker = models.CharField(max_length=254)
     executor_corp_id = models.CharField(max_length=254)
@@ -40,7 +40,7 @@ class EveAllianceInfo(models.Model):
 
 
 class EveCorporationInfo(models.Model):
-    corporation_id = models.CharField(max_length=254)
+    corporation_id = models.CharField(max_length=254, db_index=True)
     corporation_name = models.CharField(max_length=254)
     corporation_ticker = models.CharField(max_length=254)
     member_count = models.IntegerField()
@@ -1,8 +1,12 @@
 import requests
 import json
+import hashlib
 from django.conf import settings
+from django.core.cache import cache
 import re
 import os
+import time
+import threading
 from services.models import DiscordAuthToken
 
 import logging
@@ -11,7 +15,123 @@ logger = logging.getLogger(__name__)
 
 DISCORD_URL = "https://discordapp.com/api"
 
+# keep-alive connection pool shared by all Discord API calls
+session = requests.Session()
+
+
+class DiscordRequestScheduler:
+    # attempts at a request that keeps getting rate limited before giving up
+    MAX_RETRIES = 5
+    # upper bound on a single pause, guards against clock skew in reset headers
+    MAX_WAIT = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.global_reset = 0
+        # bucket -> lock serialising its requests, so waiting callers queue up
+        self.bucket_locks = {}
+        # bucket -> {'remaining', 'reset', 'queued', 'max_queued', 'requests', 'throttled', 'wait_time'}
+        self.buckets = {}
+
+    @staticmethod
+    def get_bucket(method, path):
+        # discord limits per route, keyed on the guild or channel id but not on other ids
+        route = path[len(DISCORD_URL):].split('?')[0]
+        route = re.sub(r'(?<!guilds/)(?<!channels/)\b\d+\b', ':id', route)
+        return method.upper() + " " + route
+
+    def get_state(self, bucket):
+        with self.lock:
+            if bucket not in self.buckets:
+                self.bucket_locks[bucket] = threading.Lock()
+                self.buckets[bucket] = {'remaining': None, 'reset': 0, 'queued': 0, 'max_queued': 0,
+                                        'requests': 0, 'throttled': 0, 'wait_time': 0.0}
+            return self.bucket_locks[bucket], self.buckets[bucket]
+
+    def wait(self, bucket, state):
+        now = time.time()
+        delay = self.global_reset - now
+        if state['remaining'] == 0 and state['reset'] > now:
+            delay = max(delay, state['reset'] - now)
+        if delay > 0:
+            delay = min(delay, self.MAX_WAIT)
+            logger.debug("Pacing discord bucket %s for %.2f seconds" % (bucket, delay))
+            time.sleep(delay)
+            state['wait_time'] += delay
+
+    @staticmethod
+    def update_limits(state, r):
+        remaining = r.headers.get('X-RateLimit-Remaining')
+        reset = r.headers.get('X-RateLimit-Reset')
+        if remaining is not None and reset is not None:
+            state['remaining'] = int(remaining)
+            state['reset'] = float(reset)
+
+    def request(self, method, path, **kwargs):
+        bucket = DiscordRequestScheduler.get_bucket(method, path)
+        bucket_lock, state = self.get_state(bucket)
+        with self.lock:
+            state['queued'] += 1
+            state['max_queued'] = max(state['max_queued'], state['queued'])
+        try:
+            with bucket_lock:
+                for attempt in range(self.MAX_RETRIES):
+                    self.wait(bucket, state)
+                    r = session.request(method, path, **kwargs)
+                    state['requests'] += 1
+                    self.update_limits(state, r)
+                    if r.status_code != 429:
+                        return r
+                    state['throttled'] += 1
+                    try:
+                        body = r.json()
+                    except ValueError:
+                        body = {}
+                    # retry_after is given in milliseconds
+                    retry_after = float(body.get('retry_after', 1000)) / 1000
+                    logger.warn("Rate limited by discord on bucket %s (global: %s) - retrying in %.2f seconds" % (bucket, body.get('global', False), retry_after))
+                    if body.get('global', False):
+                        self.global_reset = time.time() + retry_after
+                    else:
+                        state['remaining'] = 0
+                        state['reset'] = time.time() + retry_after
+                return r
+        finally:
+            with self.lock:
+                state['queued'] -= 1
+
+    def get(self, path, **kwargs):
+        return self.request('get', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('post', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request('patch', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('put', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('delete', path, **kwargs)
+
+    def stats(self):
+        with self.lock:
+            return dict((bucket, dict(state)) for bucket, state in self.buckets.items())
+
+# paces every Discord API call according to the rate limits discord reports
+scheduler = DiscordRequestScheduler()
+
 class DiscordAPIManager:
+    # seconds a token that passed validation is trusted without re-checking
+    TOKEN_VALIDATION_TTL = 60 * 10
+    # django cache key marking a token as recently validated, the token itself is hashed
+    TOKEN_VALIDATION_KEY = "discord_token_validated_%s"
+    # seconds a server's role name index is reused before being refetched
+    ROLE_INDEX_TTL = 60 * 5
+
+    # server id -> (fetched at, {role name: role id})
+    role_indexes = {}
 
     def __init__(self, server_id, email, password, user=None):
         self.token = DiscordAPIManager.get_token_by_user(email, password, user)
@@ -24,14 +144,28 @@ class DiscordAPIManager:
     def validate_token(token):
         custom_headers = {'accept': 'application/json', 'authorization': token}
         path = DISCORD_URL + "/users/@me"
-        r = requests.get(path, headers=custom_headers)
+        r = scheduler.get(path, headers=custom_headers)
         if r.status_code == 200:
             logger.debug("Token starting with %s passed validation." % token[0:5])
+            cache.set(DiscordAPIManager.token_validation_key(token), True, DiscordAPIManager.TOKEN_VALIDATION_TTL)
             return True
         else:
             logger.debug("Token starting with %s failed validation with status code %s" % (token[0:5], r.status_code))
+            cache.delete(DiscordAPIManager.token_validation_key(token))
             return False        
 
+    @staticmethod
+    def token_validation_key(token):
+        return DiscordAPIManager.TOKEN_VALIDATION_KEY % hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def validate_token_cached(token):
+        # the cache expires entries itself, so tokens are not kept around after their ttl
+        if cache.get(DiscordAPIManager.token_validation_key(token)):
+            logger.debug("Token starting with %s validated recently. Skipping check." % token[0:5])
+            return True
+        return DiscordAPIManager.validate_token(token)
+
     @staticmethod
     def get_auth_token():
         data = {
@@ -40,7 +174,7 @@ class DiscordAPIManager:
         }
         custom_headers = {'content-type':'application/json'}
         path = DISCORD_URL + "/auth/login"
-        r = requests.post(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.post(path, headers=custom_headers, data=json.dumps(data))
         logger.debug("Received status code %s during token generation for settings discord user." % r.status_code)
         r.raise_for_status()
         return r.json()['token']
@@ -49,7 +183,7 @@ class DiscordAPIManager:
         data = {"name": name}
         custom_headers = {'content-type':'application/json', 'authorization': self.token}
         path = DISCORD_URL + "/guilds"
-        r = requests.post(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.post(path, headers=custom_headers, data=json.dumps(data))
         r.raise_for_status()
         return r.json()
 
@@ -57,48 +191,48 @@ class DiscordAPIManager:
         data = {"name": name}
         custom_headers = {'content-type':'application/json', 'authorization': self.token}
         path = DISCORD_URL + "/guilds/" + str(self.server_id)
-        r = requests.patch(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.patch(path, headers=custom_headers, data=json.dumps(data))
         r.raise_for_status()
         return r.json()
 
     def delete_server(self):
         custom_headers = {'content-type':'application/json', 'authorization': self.token}
         path = DISCORD_URL + "/guilds/" + str(self.server_id)
-        r = requests.delete(path, headers=custom_headers)
+        r = scheduler.delete(path, headers=custom_headers)
         r.raise_for_status()
 
     def get_members(self):
         custom_headers = {'accept':'application/json', 'authorization': self.token}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/members"
-        r = requests.get(path, headers=custom_headers)
+        r = scheduler.get(path, headers=custom_headers)
         r.raise_for_status()
         return r.json()
 
     def get_bans(self):
         custom_headers = {'accept':'application/json', 'authorization': self.token}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/bans"
-        r = requests.get(path, headers=custom_headers)
+        r = scheduler.get(path, headers=custom_headers)
         r.raise_for_status()
         return r.json()
 
     def ban_user(self, user_id, delete_message_age=0):
         custom_headers = {'authorization': self.token}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/bans/" + str(user_id) + "?delete-message-days=" + str(delete_message_age)
-        r = requests.put(path, headers=custom_headers)
+        r = scheduler.put(path, headers=custom_headers)
         logger.debug("Received status code %s after banning user %s" % (r.status_code, user_id))
         r.raise_for_status()
 
     def unban_user(self, user_id):
         custom_headers = {'authorization': self.token}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/bans/" + str(user_id)
-        r = requests.delete(path, headers=custom_headers)
+        r = scheduler.delete(path, headers=custom_headers)
         logger.debug("Received status code %s after deleting ban for user %s" % (r.status_code, user_id))
         r.raise_for_status()
 
     def generate_role(self):
         custom_headers = {'accept':'application/json', 'authorization': self.token}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/roles"
-        r = requests.post(path, headers=custom_headers)
+        r = scheduler.post(path, headers=custom_headers)
         logger.debug("Received status code %s after generating new role." % r.status_code)
         r.raise_for_status()
         return r.json()
@@ -112,7 +246,7 @@ class DiscordAPIManager:
             'permissions': permissions,
         }
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/roles/" + str(role_id)
-        r = requests.patch(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.patch(path, headers=custom_headers, data=json.dumps(data))
         logger.debug("Received status code %s after editing role id %s" % (r.status_code, role_id))
         r.raise_for_status()
         return r.json()
@@ -120,21 +254,21 @@ class DiscordAPIManager:
     def delete_role(self, role_id):
         custom_headers = {'authorization': self.token}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/roles/" + str(role_id)
-        r = requests.delete(path, headers=custom_headers)
+        r = scheduler.delete(path, headers=custom_headers)
         r.raise_for_status()
 
     @staticmethod
     def get_invite(invite_id):
         custom_headers = {'accept': 'application/json'}
         path = DISCORD_URL + "/invite/" + str(invite_id)
-        r = requests.get(path, headers=custom_headers)
+        r = scheduler.get(path, headers=custom_headers)
         r.raise_for_status()
         return r.json()
 
     def accept_invite(self, invite_id):
         custom_headers = {'accept': 'application/json', 'authorization': self.token}
         path = DISCORD_URL + "/invite/" + str(invite_id)
-        r = requests.post(path, headers=custom_headers)
+        r = scheduler.post(path, headers=custom_headers)
         logger.debug("Received status code %s after accepting invite." % r.status_code)
         r.raise_for_status()
         return r.json()
@@ -148,7 +282,7 @@ class DiscordAPIManager:
             'temporary': temporary,
             'xkcdpass': xkcdpass,
         }
-        r = requests.post(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.post(path, headers=custom_headers, data=json.dumps(data))
         logger.debug("Received status code %s after creating invite." % r.status_code)
         r.raise_for_status()
         return r.json()
@@ -156,14 +290,14 @@ class DiscordAPIManager:
     def delete_invite(self, invite_id):
         custom_headers = {'authorization': self.token}
         path = DISCORD_URL + "/invite/" + str(invite_id)
-        r = requests.delete(path, headers=custom_headers)
+        r = scheduler.delete(path, headers=custom_headers)
         r.raise_for_status()
 
     def set_roles(self, user_id, role_ids):
         custom_headers = {'authorization': self.token, 'content-type':'application/json'}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/members/" + str(user_id)
         data = { 'roles': role_ids }
-        r = requests.patch(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.patch(path, headers=custom_headers, data=json.dumps(data))
         logger.debug("Received status code %s after setting roles of user %s to %s" % (r.status_code, user_id, role_ids))
         r.raise_for_status()
 
@@ -178,19 +312,43 @@ class DiscordAPIManager:
             'email': email,
         }
         path = DISCORD_URL + "/auth/register"
-        r = requests.post(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.post(path, headers=custom_headers, data=json.dumps(data))
         r.raise_for_status()
 
     def kick_user(self, user_id):
         custom_headers = {'authorization': self.token}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/members/" + str(user_id)
-        r = requests.delete(path, headers=custom_headers)
+        r = scheduler.delete(path, headers=custom_headers)
         r.raise_for_status()
 
     def get_members(self):
         custom_headers = {'authorization': self.token, 'accept':'application/json'}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/members"
-        r = requests.get(path, headers=custom_headers)
+        r = scheduler.get(path, headers=custom_headers)
+        r.raise_for_status()
+        return r.json()
+
+    def get_all_members(self, limit=1000):
+        # page through the guild member list, discord caps each page at 1000 members
+        custom_headers = {'authorization': self.token, 'accept':'application/json'}
+        members = []
+        after = 0
+        while True:
+            path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/members?limit=" + str(limit) + "&after=" + str(after)
+            r = scheduler.get(path, headers=custom_headers)
+            r.raise_for_status()
+            page = r.json()
+            members.extend(page)
+            if len(page) < limit:
+                break
+            after = page[-1]['user']['id']
+        logger.debug("Retrieved %s members from server %s" % (len(members), self.server_id))
+        return members
+
+    def get_guild(self):
+        custom_headers = {'authorization': self.token, 'accept':'application/json'}
+        path = DISCORD_URL + "/guilds/" + str(self.server_id)
+        r = scheduler.get(path, headers=custom_headers)
         r.raise_for_status()
         return r.json()
 
@@ -204,20 +362,35 @@ class DiscordAPIManager:
     def get_roles(self):
         custom_headers = {'authorization': self.token, 'accept':'application/json'}
         path = DISCORD_URL + "/guilds/" + str(self.server_id) + "/roles"
-        r = requests.get(path, headers=custom_headers)
+        r = scheduler.get(path, headers=custom_headers)
         logger.debug("Received status code %s after retrieving role list from server." % r.status_code)
         r.raise_for_status()
         return r.json()
 
+    def get_role_index(self, refresh=False):
+        cached = DiscordAPIManager.role_indexes.get(self.server_id)
+        if refresh or not cached or cached[0] + DiscordAPIManager.ROLE_INDEX_TTL < time.time():
+            index = {}
+            all_roles = self.get_roles()
+            logger.debug("Retrieved role list for server: %s" % all_roles)
+            for role in all_roles:
+                index.setdefault(role['name'], role['id'])
+            cached = (time.time(), index)
+            DiscordAPIManager.role_indexes[self.server_id] = cached
+        return cached[1]
+
+    def add_to_role_index(self, group_name, role_id):
+        self.get_role_index()[group_name] = role_id
+
     def get_group_id(self, group_name):
         logger.debug("Determining role id for group name %s" % group_name)
-        all_roles = self.get_roles()
-        logger.debug("Retrieved role list for server: %s" % all_roles)
-        for role in all_roles:
-            logger.debug("Checking role %s" % role)
-            if role['name'] == group_name:
-                logger.debug("Found role matching name: %s" % role['id'])
-                return role['id']
+        index = self.get_role_index()
+        if group_name not in index:
+            logger.debug("Role %s not in role index. Refreshing." % group_name)
+            index = self.get_role_index(refresh=True)
+        if group_name in index:
+            logger.debug("Found role matching name: %s" % index[group_name])
+            return index[group_name]
         logger.debug("Role not found on server. Raising KeyError")
         raise KeyError('Group not found on server: ' + group_name)
 
@@ -229,7 +402,7 @@ class DiscordAPIManager:
                 raise ValueError("User mismatch while validating DiscordAuthToken for email %s - user %s, requesting user %s" % (email, auth.user, user))                
             logger.debug("Discord auth token cached for supplied email starting with %s" % email[0:3])
             auth = DiscordAuthToken.objects.get(email=email, user=user)
-            if DiscordAPIManager.validate_token(auth.token):
+            if DiscordAPIManager.validate_token_cached(auth.token):
                 logger.debug("Token still valid. Returning token starting with %s" % auth.token[0:5])
                 return auth.token
             else:
@@ -242,7 +415,7 @@ class DiscordAPIManager:
         }
         custom_headers = {'content-type':'application/json'}
         path = DISCORD_URL + "/auth/login"
-        r = requests.post(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.post(path, headers=custom_headers, data=json.dumps(data))
         logger.debug("Received status code %s after generating auth token for custom user." % r.status_code)
         r.raise_for_status()
         token = r.json()['token']
@@ -254,7 +427,7 @@ class DiscordAPIManager:
     def get_profile(self):
         custom_headers = {'accept': 'application/json', 'authorization': self.token}
         path = DISCORD_URL + "/users/@me"
-        r = requests.get(path, headers=custom_headers)
+        r = scheduler.get(path, headers=custom_headers)
         logger.debug("Received status code %s after retrieving user profile with email %s" % (r.status_code, self.email[0:3]))
         r.raise_for_status()
         return r.json()
@@ -264,7 +437,7 @@ class DiscordAPIManager:
         token = DiscordAPIManager.get_token_by_user(email, password)
         custom_headers = {'accept': 'application/json', 'authorization': token}
         path = DISCORD_URL + "/users/@me"
-        r = requests.get(path, headers=custom_headers)
+        r = scheduler.get(path, headers=custom_headers)
         logger.debug("Received status code %s after retrieving user profile with email %s" % (r.status_code, email[0:3]))
         r.raise_for_status()
         return r.json()
@@ -283,7 +456,7 @@ class DiscordAPIManager:
         }
         path = DISCORD_URL + "/users/@me"
         custom_headers = {'content-type':'application/json', 'authorization': DiscordAPIManager.get_token_by_user(email, current_password)}
-        r = requests.patch(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.patch(path, headers=custom_headers, data=json.dumps(data))
         r.raise_for_status()
         return r.json()
 
@@ -297,10 +470,14 @@ class DiscordAPIManager:
         }
         path = DISCORD_URL + "/users/@me"
         custom_headers = {'content-type':'application/json', 'authorization': DiscordAPIManager.get_token_by_user(email, current_password)}
-        r = requests.patch(path, headers=custom_headers, data=json.dumps(data))
+        r = scheduler.patch(path, headers=custom_headers, data=json.dumps(data))
         r.raise_for_status
         return r.json()
 
+    @staticmethod
+    def get_rate_limit_stats():
+        return scheduler.stats()
+
     def check_if_user_banned(self, user_id):
         bans = self.get_bans()
         for b in bans:
@@ -309,9 +486,20 @@ class DiscordAPIManager:
         return False
 
 class DiscordManager:
+    # server account api reused between calls until its token needs revalidating
+    server_api = None
+    server_api_created = 0
+
     def __init__(self):
         pass
 
+    @staticmethod
+    def get_server_api():
+        if DiscordManager.server_api is None or DiscordManager.server_api_created + DiscordAPIManager.TOKEN_VALIDATION_TTL < time.time():
+            DiscordManager.server_api = DiscordAPIManager(settings.DISCORD_SERVER_ID, settings.DISCORD_USER_EMAIL, settings.DISCORD_USER_PASSWORD)
+            DiscordManager.server_api_created = time.time()
+        return DiscordManager.server_api
+
     @staticmethod
     def __sanatize_username(username):
         clean = re.sub(r'[^\w]','_', username)
@@ -325,7 +513,7 @@ class DiscordManager:
     def update_groups(user_id, groups):
         logger.debug("Updating groups for user_id %s: %s" % (user_id, groups))
         group_ids = []
-        api = DiscordAPIManager(settings.DISCORD_SERVER_ID, settings.DISCORD_USER_EMAIL, settings.DISCORD_USER_PASSWORD)
+        api = DiscordManager.get_server_api()
         if len(groups) == 0:
             logger.debug("No groups provided - generating empty array of group ids.")
             group_ids = []
@@ -340,23 +528,85 @@ class DiscordManager:
                     logger.debug("Group id retrieval generated exception - generating new group on discord server.", exc_info=True)
                     group_ids.append(DiscordManager.create_group(g))
         logger.info("Setting discord groups for user %s to %s" % (user_id, group_ids))
-        api.set_roles(user_id, group_ids)
+        try:
+            api.set_roles(user_id, group_ids)
+        except requests.exceptions.HTTPError as e:
+            # role ids come from the cached index and may be stale - refresh it and retry once.
+            # Anything else (missing member, auth, server errors) is not fixed by a retry.
+            if not DiscordManager.is_stale_role_error(e):
+                raise
+            logger.warn("Failed setting discord groups for user %s - refreshing role index and retrying." % user_id)
+            index = api.get_role_index(refresh=True)
+            group_ids = [index[g] if g in index else DiscordManager.create_group(g) for g in groups]
+            api.set_roles(user_id, group_ids)
+
+    @staticmethod
+    def is_stale_role_error(e):
+        # discord answers a PATCH naming unknown role ids with a 400 about the roles field
+        if e.response is None or e.response.status_code != 400:
+            return False
+        try:
+            body = e.response.json()
+        except ValueError:
+            return False
+        if not isinstance(body, dict):
+            return False
+        return 'roles' in body or 'roles' in (body.get('errors') or {}) or body.get('code') == 10011
 
     @staticmethod
     def create_group(groupname):
         logger.debug("Creating new group %s" % groupname)
-        api = DiscordAPIManager(settings.DISCORD_SERVER_ID, settings.DISCORD_USER_EMAIL, settings.DISCORD_USER_PASSWORD)
+        api = DiscordManager.get_server_api()
         new_group = api.generate_role()
         logger.debug("Created new role on server with id %s: %s" % (new_group['id'], new_group))
         named_group = api.edit_role(new_group['id'], groupname)
         logger.debug("Renamed group id %s to %s" % (new_group['id'], groupname))
+        api.add_to_role_index(groupname, named_group['id'])
         logger.info("Created new group on discord server with name %s" % groupname)
         return named_group['id']
 
+    @staticmethod
+    def reconcile_members(expected_groups):
+        # expected_groups maps discord user id -> group names the member should hold.
+        # Members are compared locally and only those that differ are touched.
+        api = DiscordManager.get_server_api()
+        members = api.get_all_members()
+        index = api.get_role_index(refresh=True)
+        guild = api.get_guild()
+        # roles owned by integrations can't be assigned by us and are left alone
+        managed = set(str(role['id']) for role in guild.get('roles', []) if role.get('managed'))
+        protected = set([str(api.get_profile()['id']), str(guild['owner_id'])])
+        allowlist = set(str(uid) for uid in settings.DISCORD_KICK_ALLOWLIST)
+        changed = []
+        kicked = []
+        for member in members:
+            user_id = str(member['user']['id'])
+            if user_id in protected or member['user'].get('bot'):
+                continue
+            try:
+                if user_id not in expected_groups:
+                    if settings.DISCORD_KICK_UNLINKED and user_id not in allowlist:
+                        logger.info("Kicking discord user %s - not linked to an auth account." % user_id)
+                        api.kick_user(user_id)
+                        kicked.append(user_id)
+                    continue
+                role_ids = []
+                for g in expected_groups[user_id]:
+                    role_ids.append(index[g] if g in index else DiscordManager.create_group(g))
+                member_managed = [r for r in member['roles'] if str(r) in managed]
+                if set(role_ids) != set(r for r in member['roles'] if str(r) not in managed):
+                    logger.debug("Discord user %s roles %s differ from expected %s" % (user_id, member['roles'], role_ids))
+                    api.set_roles(user_id, role_ids + member_managed)
+                    changed.append(user_id)
+            except requests.exceptions.HTTPError:
+                logger.exception("Failed to reconcile discord user %s" % user_id)
+        logger.info("Reconciled %s discord members: %s roles updated, %s kicked." % (len(members), len(changed), len(kicked)))
+        return changed, kicked
+
     @staticmethod
     def lock_user(user_id):
         try:
-            api = DiscordAPIManager(settings.DISCORD_SERVER_ID, settings.DISCORD_USER_EMAIL, settings.DISCORD_USER_PASSWORD)
+            api = DiscordManager.get_server_api()
             api.ban_user(user_id)
             return True
         except:
@@ -365,7 +615,7 @@ class DiscordManager:
     @staticmethod
     def unlock_user(user_id):
         try:
-            api = DiscordAPIManager(settings.DISCORD_SERVER_ID, settings.DISCORD_USER_EMAIL, settings.DISCORD_USER_PASSWORD)
+            api = DiscordManager.get_server_api()
             api.unban_user(user_id)
             return True
         except:
@@ -384,7 +634,7 @@ class DiscordManager:
     def add_user(email, password, user):
         try:
             logger.debug("Adding new user %s to discord with email %s and password of length %s" % (user, email[0:3], len(password)))
-            server_api = DiscordAPIManager(settings.DISCORD_SERVER_ID, settings.DISCORD_USER_EMAIL, settings.DISCORD_USER_PASSWORD)
+            server_api = DiscordManager.get_server_api()
             user_api = DiscordAPIManager(settings.DISCORD_SERVER_ID, email, password, user=user)
             profile = user_api.get_profile()
             logger.debug("Got profile for user: %s" % profile)
@@ -406,7 +656,7 @@ class DiscordManager:
     def delete_user(user_id):
         try:
             logger.debug("Deleting user with id %s from discord server." % user_id)
-            api = DiscordAPIManager(settings.DISCORD_SERVER_ID, settings.DISCORD_USER_EMAIL, settings.DISCORD_USER_PASSWORD)
+            api = DiscordManager.get_server_api()
             DiscordManager.update_groups(user_id, [])
             api.ban_user(user_id)
             logger.info("Deleted user with id %s from discord server id %s" % (user_id, settings.DISCORD_SERVER_ID))
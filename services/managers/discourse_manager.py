@@ -1,11 +1,10 @@
 import logging
 import requests
 import os
+import time
 import datetime
-import json
 from django.conf import settings
-from django.utils import timezone
-from services.models import GroupCache
+from django.core.cache import cache
 
 logger = logging.getLogger(__name__)
 
@@ -115,10 +114,18 @@ ENDPOINTS = {
 
 class DiscourseManager:
     GROUP_CACHE_MAX_AGE = datetime.timedelta(minutes=30)
+    # shared between processes through the django cache
+    GROUP_CACHE_KEY = 'discourse_group_index'
+    GROUP_CACHE_LOCK_KEY = 'discourse_group_index_lock'
+    # seconds other processes wait for the one fetching the group list
+    GROUP_CACHE_LOCK_TIMEOUT = 30
     REVOKED_EMAIL = 'revoked@' + settings.DOMAIN
     SUSPEND_DAYS = 99999
     SUSPEND_REASON = "Disabled by auth."
 
+    # in process copy of the group index
+    group_index = None
+
     @staticmethod
     def __exc(endpoint, *args, **kwargs):
         params = {
@@ -164,46 +171,71 @@ class DiscourseManager:
         return [g for g in data if not g['automatic']]
 
     @staticmethod
-    def __update_group_cache():
-        GroupCache.objects.filter(service="discourse").delete()
-        cache = GroupCache.objects.create(service="discourse")
-        cache.groups = json.dumps(DiscourseManager.__get_groups())
-        cache.save()
-        return cache
+    def __fetch_group_index(newer_than):
+        # only one process fetches the group list at a time, the others wait for its result
+        # needs a CACHES backend shared between processes, with the default LocMemCache this only
+        # coordinates the threads of one process
+        max_age = int(DiscourseManager.GROUP_CACHE_MAX_AGE.total_seconds())
+        acquired = cache.add(DiscourseManager.GROUP_CACHE_LOCK_KEY, True, DiscourseManager.GROUP_CACHE_LOCK_TIMEOUT)
+        if not acquired:
+            deadline = time.time() + DiscourseManager.GROUP_CACHE_LOCK_TIMEOUT
+            while time.time() < deadline:
+                time.sleep(0.1)
+                index = cache.get(DiscourseManager.GROUP_CACHE_KEY)
+                if index and index[0] > newer_than:
+                    return index
+            logger.warn("Timed out waiting for another process to fetch discourse groups.")
+        try:
+            logger.debug("Fetching discourse group list.")
+            fetched = time.time()
+            groups = DiscourseManager.__get_groups()
+            index = (fetched, dict((g['name'], g['id']) for g in groups), dict((g['id'], g['name']) for g in groups))
+            cache.set(DiscourseManager.GROUP_CACHE_KEY, index, max_age)
+            return index
+        finally:
+            # after a timed out wait the lock still belongs to the other process
+            if acquired:
+                cache.delete(DiscourseManager.GROUP_CACHE_LOCK_KEY)
 
     @staticmethod
-    def __get_group_cache():
-        if not GroupCache.objects.filter(service="discourse").exists():
-            DiscourseManager.__update_group_cache()
-        cache = GroupCache.objects.get(service="discourse")
-        age = timezone.now() - cache.created
-        if age > DiscourseManager.GROUP_CACHE_MAX_AGE:
-            logger.debug("Group cache has expired. Triggering update.")
-            cache = DiscourseManager.__update_group_cache()
-        return json.loads(cache.groups)
+    def __get_group_index(newer_than=None):
+        # (fetched at, {name: id}, {id: name}), kept in process and in the django cache.
+        # newer_than forces an index fetched after that time, e.g. after a lookup miss.
+        expires = time.time() - DiscourseManager.GROUP_CACHE_MAX_AGE.total_seconds()
+        oldest = max(expires, newer_than) if newer_than is not None else expires
+        index = DiscourseManager.group_index
+        if not index or index[0] <= oldest:
+            index = cache.get(DiscourseManager.GROUP_CACHE_KEY)
+            if not index or index[0] <= oldest:
+                index = DiscourseManager.__fetch_group_index(oldest)
+            DiscourseManager.group_index = index
+        return index
 
     @staticmethod
     def __create_group(name):
         endpoint = ENDPOINTS['groups']['create']
+        created = time.time()
         DiscourseManager.__exc(endpoint, name=name[:20], visible=True)
-        DiscourseManager.__update_group_cache()
+        return DiscourseManager.__get_group_index(newer_than=created)
 
     @staticmethod
     def __group_name_to_id(name):
-        cache = DiscourseManager.__get_group_cache()
-        for g in cache:
-            if g['name'] == name[0:20]:
-                return g['id']
-        logger.debug("Group %s not found on Discourse. Creating" % name)
-        DiscourseManager.__create_group(name)
-        return DiscourseManager.__group_name_to_id(name)
+        name = name[0:20]
+        index = DiscourseManager.__get_group_index()
+        if not name in index[1]:
+            index = DiscourseManager.__get_group_index(newer_than=index[0])
+        if not name in index[1]:
+            logger.debug("Group %s not found on Discourse. Creating" % name)
+            index = DiscourseManager.__create_group(name)
+        return index[1][name]
 
     @staticmethod
     def __group_id_to_name(id):
-        cache = DiscourseManager.__get_group_cache()
-        for g in cache:
-            if g['id'] == id:
-                return g['name']
+        index = DiscourseManager.__get_group_index()
+        if not id in index[2]:
+            index = DiscourseManager.__get_group_index(newer_than=index[0])
+        if id in index[2]:
+            return index[2][id]
         raise KeyError("Group ID %s not found on Discourse" % id)
 
     @staticmethod
@@ -329,7 +361,7 @@ class DiscourseManager:
         inv_group_dict = {v:k for k,v in group_dict.items()}
         user_groups = DiscourseManager.__get_user_groups(username)
         add_groups = [group_dict[x] for x in group_dict if not group_dict[x] in user_groups]
-        rem_groups = [x for x in user_groups if not inv_group_dict[x] in groups]
+        rem_groups = [x for x in user_groups if not x in inv_group_dict]
         if add_groups or rem_groups:
             logger.info("Updating discourse user %s groups: adding %s, removing %s" % (username, add_groups, rem_groups))
             for g in add_groups:
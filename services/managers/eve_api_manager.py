@@ -3,12 +3,48 @@ import evelink.char
 import evelink.eve
 
 from django.conf import settings
+from django.core.cache import cache
 
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
+class EveApiCache(evelink.api.APICache):
+    """Stores raw API responses in Django's cache until their cachedUntil."""
+    def __init__(self, prefix="evelink"):
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = cache.get("%s_%s" % (self.prefix, key))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value, duration):
+        if duration > 0:
+            cache.set("%s_%s" % (self.prefix, key), value, int(duration))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
+
+api_cache = EveApiCache()
+
 class EveApiManager():
+    # key info results by (api_id, api_key), reused until their cachedUntil
+    key_info_cache = {}
+    # parsed alliance list keyed by alliance id, reused until its cachedUntil
+    alliances = None
+
     def __init__(self):
         pass
 
@@ -16,10 +52,9 @@ class EveApiManager():
     def get_characters_from_api(api_id, api_key):
         chars = []
         logger.debug("Getting characters from api id %s" % api_id)
-        api = evelink.api.API(api_key=(api_id, api_key))
-        # Should get characters
-        account = evelink.account.Account(api=api)
-        chars = account.characters()
+        # key info lists the same characters as account/Characters
+        info = EveApiManager.get_api_info(api_id, api_key)
+        chars = evelink.api.APIResult(info.result['characters'], info.timestamp, info.expires)
         logger.debug("Retrieved characters %s from api id %s" % (chars, api_id))
         return chars
 
@@ -27,7 +62,7 @@ class EveApiManager():
     def get_corporation_ticker_from_id(corp_id):
         logger.debug("Getting ticker for corp id %s" % corp_id)
         ticker = ""
-        api = evelink.api.API()
+        api = evelink.api.API(cache=api_cache)
         corp = evelink.corp.Corp(api)
         response = corp.corporation_sheet(corp_id)
         logger.debug("Retrieved corp sheet for id %s: %s" % (corp_id, response))
@@ -35,13 +70,24 @@ class EveApiManager():
         logger.debug("Determined corp id %s ticker: %s" % (corp_id, ticker))
         return ticker
 
+    @staticmethod
+    def get_alliances():
+        alliances = EveApiManager.alliances
+        if alliances and alliances.expires > time.time():
+            return alliances
+        logger.debug("Getting alliance list")
+        api = evelink.api.API(cache=api_cache)
+        eve = evelink.eve.EVE(api=api)
+        alliances = eve.alliances()
+        logger.debug("Got %s alliances, cached until %s" % (len(alliances.result), alliances.expires))
+        EveApiManager.alliances = alliances
+        return alliances
+
     @staticmethod
     def get_alliance_information(alliance_id):
         results = {}
         logger.debug("Getting info for alliance with id %s" % alliance_id)
-        api = evelink.api.API()
-        eve = evelink.eve.EVE(api=api)
-        alliance = eve.alliances()
+        alliance = EveApiManager.get_alliances()
         results = alliance[0][int(alliance_id)]
         logger.debug("Got alliance info %s" % results)
         return results
@@ -50,7 +96,7 @@ class EveApiManager():
     def get_corporation_information(corp_id):
         logger.debug("Getting info for corp with id %s" % corp_id)
         results = {}
-        api = evelink.api.API()
+        api = evelink.api.API(cache=api_cache)
         corp = evelink.corp.Corp(api=api)
         corpinfo = corp.corporation_sheet(corp_id=int(corp_id))
         results = corpinfo[0]
@@ -60,53 +106,65 @@ class EveApiManager():
     @staticmethod
     def check_api_is_type_account(api_id, api_key):
         logger.debug("Checking if api id %s is account." % api_id)
-        api = evelink.api.API(api_key=(api_id, api_key))
-        account = evelink.account.Account(api=api)
-        info = account.key_info()
+        info = EveApiManager.get_api_info(api_id, api_key)
         logger.debug("API id %s is type %s" % (api_id, info[0]['type']))
         return info[0]['type'] == "account"
 
     @staticmethod
     def check_api_is_full(api_id, api_key):
         logger.debug("Checking if api id %s meets member requirements." % api_id)
-        api = evelink.api.API(api_key=(api_id, api_key))
-        account = evelink.account.Account(api=api)
-        info = account.key_info()
+        info = EveApiManager.get_api_info(api_id, api_key)
         logger.debug("API has mask %s, required is %s" % (info[0]['access_mask'], settings.MEMBER_API_MASK))
         return info[0]['access_mask'] & int(settings.MEMBER_API_MASK) == int(settings.MEMBER_API_MASK)
 
     @staticmethod
     def check_blue_api_is_full(api_id, api_key):
         logger.debug("Checking if api id %s meets blue requirements." % api_id)
-        api = evelink.api.API(api_key=(api_id, api_key))
-        account = evelink.account.Account(api=api)
-        info = account.key_info()
+        info = EveApiManager.get_api_info(api_id, api_key)
         logger.debug("API has mask %s, required is %s" % (info[0]['access_mask'], settings.BLUE_API_MASK))
         return info[0]['access_mask'] & int(settings.BLUE_API_MASK) == int(settings.BLUE_API_MASK)
  
     @staticmethod
     def get_api_info(api_id, api_key):
+        cache_key = (str(api_id), str(api_key))
+        info = EveApiManager.key_info_cache.get(cache_key)
+        if info and info.expires > time.time():
+            logger.debug("Using cached api info for key id %s until %s" % (api_id, info.expires))
+            return info
         logger.debug("Getting api info for key id %s" % api_id)
-        api = evelink.api.API(api_key=(api_id, api_key))
+        api = evelink.api.API(api_key=(api_id, api_key), cache=api_cache)
         account = evelink.account.Account(api=api)
         info = account.key_info()
         logger.debug("Got info for api id %s: %s" % (api_id, info))
+        EveApiManager.prune_key_info_cache()
+        EveApiManager.key_info_cache[cache_key] = info
         return info
 
+    @staticmethod
+    def prune_key_info_cache():
+        now = time.time()
+        for cache_key, info in EveApiManager.key_info_cache.items():
+            if info.expires <= now:
+                EveApiManager.key_info_cache.pop(cache_key, None)
+
     @staticmethod
     def api_key_is_valid(api_id, api_key):
         logger.debug("Checking if api id %s is valid." % api_id)
-        api = evelink.api.API(api_key=(api_id, api_key))
-        account = evelink.account.Account(api=api)
-        info = account.key_info()
+        info = EveApiManager.get_api_info(api_id, api_key)
         logger.info("Verified api id %s is still valid." % api_id)
         return True
 
+    @staticmethod
+    def get_api_cache_stats():
+        stats = api_cache.stats()
+        logger.debug("EVE API cache stats: %s" % stats)
+        return stats
+
     @staticmethod
     def check_if_api_server_online():
         logger.debug("Checking if API server online.")
         try:
-            api = evelink.api.API()
+            api = evelink.api.API(cache=api_cache)
             server = evelink.server.Server(api=api)
             info = server.server_status()
             logger.info("Verified API server is online and reachable.")
@@ -121,7 +179,7 @@ class EveApiManager():
     def check_if_id_is_corp(corp_id):
         logger.debug("Checking if id %s is a corp." % corp_id)
         try:
-            api = evelink.api.API()
+            api = evelink.api.API(cache=api_cache)
             corp = evelink.corp.Corp(api=api)
             corpinfo = corp.corporation_sheet(corp_id=int(corp_id))
             results = corpinfo[0]
@@ -140,7 +198,7 @@ class EveApiManager():
     def get_corp_standings():
         if settings.CORP_API_ID and settings.CORP_API_VCODE:
             logger.debug("Getting corp standings with api id %s" % settings.CORP_API_ID)
-            api = evelink.api.API(api_key=(settings.CORP_API_ID, settings.CORP_API_VCODE))
+            api = evelink.api.API(api_key=(settings.CORP_API_ID, settings.CORP_API_VCODE), cache=api_cache)
             corp = evelink.corp.Corp(api=api)
             corpinfo = corp.contacts()
             results = corpinfo.result
@@ -154,7 +212,7 @@ class EveApiManager():
     def get_corp_membertracking(api, vcode):
         try:
             logger.debug("Getting corp membertracking with api id %s" % settings.CORP_API_ID)
-            api = evelink.api.API(api_key=(api, vcode))
+            api = evelink.api.API(api_key=(api, vcode), cache=api_cache)
             corp = evelink.corp.Corp(api=api)
             membertracking = corp.members()
             results = membertracking.result
@@ -169,9 +227,7 @@ class EveApiManager():
     def check_if_id_is_alliance(alliance_id):
         logger.debug("Checking if id %s is an alliance." % alliance_id)
         try:
-            api = evelink.api.API()
-            eve = evelink.eve.EVE(api=api)
-            alliance = eve.alliances()
+            alliance = EveApiManager.get_alliances()
             results = alliance.result[int(alliance_id)]
             if results:
                 logger.debug("Confirmed id %s is an alliance." % alliance_id)
@@ -188,7 +244,7 @@ class EveApiManager():
     def check_if_id_is_character(character_id):
         logger.debug("Checking if id %s is a character." % character_id)
         try:
-            api = evelink.api.API()
+            api = evelink.api.API(cache=api_cache)
             eve = evelink.eve.EVE(api=api)
             results = eve.character_info_from_id(character_id)
             if results:
@@ -204,9 +260,7 @@ class EveApiManager():
     def check_if_alliance_exists(alliance_id):
         logger.debug("Checking if alliance id %s exists." % alliance_id)
         try:
-            api = evelink.api.API()
-            eve = evelink.eve.EVE(api=api)
-            alliances = eve.alliances()
+            alliances = EveApiManager.get_alliances()
             if int(alliance_id) in alliances[0]:
                 logger.debug("Verified alliance id %s exists." % alliance_id)
                 return True
@@ -227,7 +281,7 @@ class EveApiManager():
     def check_if_corp_exists(corp_id):
         logger.debug("Checking if corp id %s exists." % corp_id)
         try:
-            api = evelink.api.API()
+            api = evelink.api.API(cache=api_cache)
             corp = evelink.corp.Corp(api=api)
             corpinfo = corp.corporation_sheet(corp_id=corp_id)
             if corpinfo[0]['members']['current'] > 0:
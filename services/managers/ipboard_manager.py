@@ -4,6 +4,8 @@ from hashlib import md5
 
 from django.conf import settings
 
+from services.managers.util.db import metered
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -33,7 +35,8 @@ class IPBoardManager:
             params['api_module'] = settings.IPBOARD_APIMODULE
             print params
 
-            return getattr(server, func)(params)
+            with metered('ipboard', func):
+                return getattr(server, func)(params)
         except:
             return {}
 
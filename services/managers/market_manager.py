@@ -3,7 +3,7 @@ from django.conf import settings
 import requests
 import os
 
-from django.db import connections
+from services.managers.util.db import service_cursor
 from passlib.hash import bcrypt
 ## requires yum install libffi-devel and pip install bcrypt
 
@@ -35,9 +35,9 @@ class marketManager:
     @staticmethod
     def check_username(username):
         logger.debug("Checking alliance market username %s" % username)
-        cursor = connections['market'].cursor()
-        cursor.execute(marketManager.SQL_CHECK_USERNAME, [marketManager.__santatize_username(username)])
-        row = cursor.fetchone()
+        with service_cursor('market') as cursor:
+            cursor.execute(marketManager.SQL_CHECK_USERNAME, [marketManager.__santatize_username(username)])
+            row = cursor.fetchone()
         if row:
             logger.debug("Found user %s on alliance market" % username)
             return True
@@ -47,9 +47,9 @@ class marketManager:
     @staticmethod
     def check_user_email(username, email):
         logger.debug("Checking if alliance market email exists for user %s" % username)
-        cursor = connections['market'].cursor()
-        cursor.execute(marketManager.SQL_CHECK_EMAIL, [email])
-        row = cursor.fetchone()
+        with service_cursor('market') as cursor:
+            cursor.execute(marketManager.SQL_CHECK_EMAIL, [email])
+            row = cursor.fetchone()
         if row:
             logger.debug("Found user %s email address on alliance market" % username)
             return True
@@ -70,9 +70,9 @@ class marketManager:
             if marketManager.check_user_email(username, email) == False:
                 try:
                     logger.debug("Adding user %s to alliance market" % username)
-                    cursor = connections['market'].cursor()
-                    cursor.execute(marketManager.SQL_ADD_USER, [username_clean, username_clean, email, email, salt,
-                                                                hash, characterid, charactername])
+                    with service_cursor('market') as cursor:
+                        cursor.execute(marketManager.SQL_ADD_USER, [username_clean, username_clean, email, email, salt,
+                                                                    hash, characterid, charactername])
                     return username_clean, plain_password
                 except:
                     logger.debug("Unsuccessful attempt to add market user %s" % username)
@@ -89,8 +89,8 @@ class marketManager:
     @staticmethod
     def disable_user(username):
         logger.debug("Disabling alliance market user %s " % username)
-        cursor = connections['market'].cursor()
-        cursor.execute(marketManager.SQL_DISABLE_USER, [username])
+        with service_cursor('market') as cursor:
+            cursor.execute(marketManager.SQL_DISABLE_USER, [username])
         return True
 
     @staticmethod
@@ -102,8 +102,8 @@ class marketManager:
             hash_result = hash
             rounds_striped = hash_result.strip('$2a$13$')
             salt = rounds_striped[:22]
-            cursor = connections['market'].cursor()
-            cursor.execute(marketManager.SQL_UPDATE_PASSWORD, [hash, salt, username_clean])
+            with service_cursor('market') as cursor:
+                cursor.execute(marketManager.SQL_UPDATE_PASSWORD, [hash, salt, username_clean])
             return plain_password
         else:
             logger.error("Unable to update alliance market user %s password" % username)
@@ -119,8 +119,8 @@ class marketManager:
             hash_result = hash
             rounds_striped = hash_result.strip('$2a$13$')
             salt = rounds_striped[:22]
-            cursor = connections['market'].cursor()
-            cursor.execute(marketManager.SQL_UPDATE_PASSWORD, [hash, salt, username_clean])
+            with service_cursor('market') as cursor:
+                cursor.execute(marketManager.SQL_UPDATE_PASSWORD, [hash, salt, username_clean])
             return plain_password
         else:
             logger.error("Unable to update alliance market user %s password" % username)
@@ -136,8 +136,8 @@ class marketManager:
             hash_result = hash
             rounds_striped = hash_result.strip('$2a$13$')
             salt = rounds_striped[:22]
-            cursor = connections['market'].cursor()
-            cursor.execute(marketManager.SQL_UPDATE_USER, [hash, salt, username_clean])
+            with service_cursor('market') as cursor:
+                cursor.execute(marketManager.SQL_UPDATE_USER, [hash, salt, username_clean])
             return username_clean, plain_password
         except:
             logger.debug("Alliance market update user failed for %s" % username)
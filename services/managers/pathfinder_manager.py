@@ -2,7 +2,7 @@ import logging
 from django.conf import settings
 import requests
 import os
-from django.db import connections
+from services.managers.util.db import service_cursor
 from passlib.hash import bcrypt
 from eveonline.managers import EveManager
 from authentication.managers import AuthServicesInfo
@@ -23,6 +23,16 @@ class pathfinderManager:
     SQL_CHECK_USER = r"SELECT name FROM user WHERE name = %s"
     SQL_CHECK_EMAIL = r"SELECT email from user WHERE email = %s"
     SQL_SET_MAIN = r"UPDATE user_character SET isMain = 1 WHERE characterId = %s"
+    SQL_GET_USERIDS = r"SELECT id, name FROM user WHERE name IN (%s)"
+    SQL_GET_APIS = r"SELECT id, userId, keyId, vCode FROM user_api WHERE userId IN (%s)"
+    SQL_GET_CHARACTERS = r"SELECT userId, apiId, characterId, isMain FROM user_character WHERE userId IN (%s)"
+    SQL_UPDATE_API = r"UPDATE user_api SET vCode = %s WHERE id = %s"
+    SQL_UPDATE_CHARACTER = r"UPDATE user_character SET apiId = %s, isMain = %s WHERE userId = %s AND characterId = %s"
+    SQL_DEL_APIS = r"DELETE FROM user_api WHERE userId = %%s AND id IN (%s)"
+    SQL_DEL_CHARACTERS = r"DELETE FROM user_character WHERE userId = %%s AND characterId IN (%s)"
+
+    # users per bulk statement
+    BULK_SIZE = 500
 
 
     @staticmethod
@@ -37,9 +47,9 @@ class pathfinderManager:
     @staticmethod
     def check_username(username):
         logger.debug("Checking for pathfinder username %s" % username)
-        cursor = connections['pathfinder'].cursor()
-        cursor.execute(pathfinderManager.SQL_CHECK_USER, [pathfinderManager.__santatize_username(username)])
-        row = cursor.fetchone()
+        with service_cursor('pathfinder') as cursor:
+            cursor.execute(pathfinderManager.SQL_CHECK_USER, [pathfinderManager.__santatize_username(username)])
+            row = cursor.fetchone()
         if row:
             logger.debug("Found user %s on pathfinder" % username)
             return True
@@ -53,8 +63,8 @@ class pathfinderManager:
             username_clean = pathfinderManager.__santatize_username(username)
             plain_password = pathfinderManager.__generate_random_pass()
             passwd = bcrypt.encrypt(plain_password, rounds=10)
-            cursor = connections['pathfinder'].cursor()
-            cursor.execute(pathfinderManager.SQL_UPDATE_USER, [passwd, username_clean])
+            with service_cursor('pathfinder') as cursor:
+                cursor.execute(pathfinderManager.SQL_UPDATE_USER, [passwd, username_clean])
             return username_clean, plain_password
         except:
             logger.debug("Pathfinder update user failed for %s" % username)
@@ -66,8 +76,8 @@ class pathfinderManager:
         if pathfinderManager.check_username(username):
             username_clean = pathfinderManager.__santatize_username(username)
             passwd = bcrypt.encrypt(plain_password, rounds=10)
-            cursor = connections['pathfinder'].cursor()
-            cursor.execute(pathfinderManager.SQL_UPDATE_USER, [passwd, username_clean])
+            with service_cursor('pathfinder') as cursor:
+                cursor.execute(pathfinderManager.SQL_UPDATE_USER, [passwd, username_clean])
             return plain_password
         else:
             logger.error("Unable to update ips4 user %s password" % username)
@@ -78,8 +88,8 @@ class pathfinderManager:
         logger.debug("Disabling user %s" % username)
         if pathfinderManager.check_username(username) == True:
             try:
-                cursor = connections['pathfinder'].cursor()
-                cursor.execute(pathfinderManager.SQL_DISABLE_USER, [pathfinderManager.__santatize_username(username)])
+                with service_cursor('pathfinder') as cursor:
+                    cursor.execute(pathfinderManager.SQL_DISABLE_USER, [pathfinderManager.__santatize_username(username)])
                 return True
             except:
                 logger.debug("User %s not found cannot disable" % username)
@@ -98,21 +108,13 @@ class pathfinderManager:
             if pathfinderManager.check_email(username, email) == False:
                 try:
                     logger.debug("Adding user %s to pathfinder" % username)
-                    cursor = connections['pathfinder'].cursor()
-                    cursor.execute(pathfinderManager.SQL_ADD_USER, [username_clean,email, passwd, '1'])
-                    path_id = pathfinderManager.get_pathfinder_user_id(username_clean)
-                    api_keys = pathfinderManager.get_api_key_pairs(auth_id)
                     main_character = AuthServicesInfo.objects.get(user=auth_id).main_char_id
-
-                    for keyId, key in api_keys.items():
-                        cursor.execute(pathfinderManager.SQL_ADD_API, [path_id, keyId, key, '1'])
-
-                    char_apis  = pathfinderManager.get_char_id(auth_id)
-
-                    for c,a in char_apis.items():
-                        cursor.execute(pathfinderManager.SQL_ADD_CHARACTER, [path_id, (pathfinderManager.get_pathfinder_api_id(username, path_id)), c, '0'])
-
-                    pathfinderManager.set_main_char(username, main_character)
+                    characters = pathfinderManager.get_user_characters([auth_id])[auth_id]
+                    # the user, its api keys and characters are written in one transaction
+                    with service_cursor('pathfinder', atomic=True) as cursor:
+                        cursor.execute(pathfinderManager.SQL_ADD_USER, [username_clean,email, passwd, '1'])
+                        path_id = pathfinderManager.get_pathfinder_user_id(username_clean)
+                        pathfinderManager.sync_characters({path_id: characters + (main_character,)}, new=True)
                     return username_clean, plain_password
 
                 except:
@@ -130,20 +132,130 @@ class pathfinderManager:
     @staticmethod
     def set_main_char (username, main_character):
         try:
-            cursor = connections['pathfinder'].cursor()
-            cursor.execute(pathfinderManager.SQL_SET_MAIN, [main_character])
+            with service_cursor('pathfinder') as cursor:
+                cursor.execute(pathfinderManager.SQL_SET_MAIN, [main_character])
         except:
             logger.debug("Failed setting main character for user %s"% username)
             return ""
 
     @staticmethod
     def get_api_key_pairs(user_id):
-        char = EveCharacter.objects.all().filter(user_id=user_id)
-        api_list = dict()
-        for c in char:
-            api_pair = EveApiKeyPair.objects.get(api_id=c.api_id)
-            api_list[api_pair.api_id] = api_pair.api_key
-        return api_list
+        api_ids = EveCharacter.objects.filter(user_id=user_id).values_list('api_id', flat=True)
+        return dict(EveApiKeyPair.objects.filter(api_id__in=set(api_ids)).values_list('api_id', 'api_key'))
+
+    @staticmethod
+    def get_user_characters(user_ids):
+        # auth user id -> ({api id: vcode}, {character id: api id}) in two queries
+        out = dict((user_id, ({}, {})) for user_id in user_ids)
+        chars = EveCharacter.objects.filter(user_id__in=user_ids).values_list('user_id', 'character_id', 'api_id')
+        keys = dict(EveApiKeyPair.objects.filter(api_id__in=set(c[2] for c in chars)).values_list('api_id', 'api_key'))
+        for user_id, character_id, api_id in chars:
+            if api_id in keys:
+                out[user_id][0][api_id] = keys[api_id]
+                out[user_id][1][character_id] = api_id
+        return out
+
+    @staticmethod
+    def chunks(items):
+        items = list(items)
+        for i in range(0, len(items), pathfinderManager.BULK_SIZE):
+            yield items[i:i + pathfinderManager.BULK_SIZE]
+
+    @staticmethod
+    def sync_characters(users, new=False):
+        """
+        Align pathfinder api keys and characters with auth for many users at once
+        @param users: pathfinder user id -> (api keys {api id: vcode}, characters {character id: api id}, main character id)
+        @param new: the users have no api keys or characters yet, skip reading them
+        @return: list of pathfinder user ids whose rows changed
+        """
+        # pathfinder user id -> {api id: (row id, vcode)} and {character id: (api row id, is main)}
+        apis = dict((path_id, {}) for path_id in users)
+        chars = dict((path_id, {}) for path_id in users)
+        with service_cursor('pathfinder', atomic=True) as cursor:
+            if not new:
+                for chunk in pathfinderManager.chunks(users):
+                    placeholders = ", ".join(["%s"] * len(chunk))
+                    cursor.execute(pathfinderManager.SQL_GET_APIS % placeholders, chunk)
+                    for row_id, path_id, key_id, vcode in cursor.fetchall():
+                        apis[path_id][str(key_id)] = (row_id, vcode)
+                    cursor.execute(pathfinderManager.SQL_GET_CHARACTERS % placeholders, chunk)
+                    for path_id, api_row_id, character_id, is_main in cursor.fetchall():
+                        chars[path_id][str(character_id)] = (api_row_id, str(is_main))
+
+            changed = set()
+            add_apis = []
+            update_apis = []
+            for path_id, (api_keys, characters, main_character) in users.items():
+                for api_id, vcode in api_keys.items():
+                    if api_id not in apis[path_id]:
+                        add_apis.append((path_id, api_id, vcode, '1'))
+                    elif apis[path_id][api_id][1] != vcode:
+                        update_apis.append((vcode, apis[path_id][api_id][0]))
+                        changed.add(path_id)
+            if add_apis:
+                cursor.executemany(pathfinderManager.SQL_ADD_API, add_apis)
+                # pick up the row ids of the keys just inserted
+                for chunk in pathfinderManager.chunks(set(row[0] for row in add_apis)):
+                    cursor.execute(pathfinderManager.SQL_GET_APIS % ", ".join(["%s"] * len(chunk)), chunk)
+                    for row_id, path_id, key_id, vcode in cursor.fetchall():
+                        apis[path_id][str(key_id)] = (row_id, vcode)
+                changed.update(row[0] for row in add_apis)
+            if update_apis:
+                cursor.executemany(pathfinderManager.SQL_UPDATE_API, update_apis)
+
+            add_chars = []
+            update_chars = []
+            stale = []
+            for path_id, (api_keys, characters, main_character) in users.items():
+                for character_id, api_id in characters.items():
+                    api_row_id = apis[path_id][api_id][0]
+                    is_main = '1' if str(character_id) == str(main_character) else '0'
+                    if character_id not in chars[path_id]:
+                        add_chars.append((path_id, api_row_id, character_id, is_main))
+                    elif chars[path_id][character_id] != (api_row_id, is_main):
+                        update_chars.append((api_row_id, is_main, path_id, character_id))
+                stale_chars = [c for c in chars[path_id] if c not in characters]
+                stale_apis = [row_id for api_id, (row_id, vcode) in apis[path_id].items() if api_id not in api_keys]
+                if stale_chars or stale_apis:
+                    stale.append((path_id, stale_chars, stale_apis))
+            if add_chars:
+                cursor.executemany(pathfinderManager.SQL_ADD_CHARACTER, add_chars)
+            if update_chars:
+                cursor.executemany(pathfinderManager.SQL_UPDATE_CHARACTER, update_chars)
+            # characters are moved off stale keys above before the keys are deleted
+            for path_id, stale_chars, stale_apis in stale:
+                if stale_chars:
+                    cursor.execute(pathfinderManager.SQL_DEL_CHARACTERS % ", ".join(["%s"] * len(stale_chars)),
+                                   [path_id] + stale_chars)
+                if stale_apis:
+                    cursor.execute(pathfinderManager.SQL_DEL_APIS % ", ".join(["%s"] * len(stale_apis)),
+                                   [path_id] + stale_apis)
+            changed.update(row[0] for row in add_chars)
+            changed.update(row[2] for row in update_chars)
+            changed.update(row[0] for row in stale)
+        logger.debug("Synced pathfinder characters for %s users: %s api keys added, %s characters added, %s updated, %s users with stale rows" % (
+            len(users), len(add_apis), len(add_chars), len(update_chars), len(stale)))
+        return list(changed)
+
+    @staticmethod
+    def resync_characters(accounts):
+        """
+        Align pathfinder characters with auth for existing pathfinder users
+        @param accounts: pathfinder username -> (auth user id, main character id)
+        @return: list of pathfinder usernames whose rows changed
+        """
+        path_ids = {}
+        with service_cursor('pathfinder') as cursor:
+            for chunk in pathfinderManager.chunks(accounts):
+                cursor.execute(pathfinderManager.SQL_GET_USERIDS % ", ".join(["%s"] * len(chunk)), chunk)
+                path_ids.update((name, path_id) for path_id, name in cursor.fetchall())
+        for username in set(accounts) - set(path_ids):
+            logger.error("Username %s not found on pathfinder. Unable to sync characters." % username)
+        characters = pathfinderManager.get_user_characters([accounts[name][0] for name in path_ids])
+        users = dict((path_id, characters[accounts[name][0]] + (accounts[name][1],)) for name, path_id in path_ids.items())
+        changed = set(pathfinderManager.sync_characters(users))
+        return [name for name, path_id in path_ids.items() if path_id in changed]
 
     @staticmethod
     def get_char_id(auth_id):
@@ -161,9 +273,9 @@ class pathfinderManager:
 
     @staticmethod
     def get_pathfinder_user_id(username):
-        cursor = connections['pathfinder'].cursor()
-        cursor.execute(pathfinderManager.SQL_GET_USERID, [username])
-        row = cursor.fetchone()
+        with service_cursor('pathfinder') as cursor:
+            cursor.execute(pathfinderManager.SQL_GET_USERID, [username])
+            row = cursor.fetchone()
         if row:
             logger.debug("Pathfinder ID for user %s is %s" % (username, row[0]))
             return int(row[0])
@@ -173,9 +285,9 @@ class pathfinderManager:
 
     @staticmethod
     def get_pathfinder_api_id(username, path_id):
-        cursor = connections['pathfinder'].cursor()
-        cursor.execute(pathfinderManager.SQL_GET_APIID, [path_id])
-        row = cursor.fetchone()
+        with service_cursor('pathfinder') as cursor:
+            cursor.execute(pathfinderManager.SQL_GET_APIID, [path_id])
+            row = cursor.fetchone()
         if row:
             logger.debug("Pathfinder API ID for user %s is %s" % (username, row[0]))
             return int(row[0])
@@ -186,9 +298,9 @@ class pathfinderManager:
     @staticmethod
     def check_email(username, email):
         logger.debug("Checking if email %s exists for username %s" % (email,username))
-        cursor = connections['pathfinder'].cursor()
-        cursor.execute(pathfinderManager.SQL_CHECK_EMAIL, [email])
-        row = cursor.fetchone()
+        with service_cursor('pathfinder') as cursor:
+            cursor.execute(pathfinderManager.SQL_CHECK_EMAIL, [email])
+            row = cursor.fetchone()
         if row:
             logger.debug("Found user %s email on pathfinder" % username)
             return True
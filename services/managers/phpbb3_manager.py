@@ -1,14 +1,17 @@
 import os
+import time
 import calendar
 from datetime import datetime
 
 from passlib.apps import phpbb3_context
-from django.db import connections
+from django.db import transaction
 
 import logging
 
 from django.conf import settings
 
+from services.managers.util.db import service_cursor
+
 logger = logging.getLogger(__name__)
 
 class Phpbb3Manager:
@@ -45,6 +48,24 @@ class Phpbb3Manager:
 
     SQL_DEL_AUTOLOGIN = r"DELETE FROM phpbb_sessions_keys where user_id = %s"
 
+    SQL_USER_IDS_FROM_USERNAMES = r"SELECT user_id, username_clean from phpbb_users WHERE username_clean IN (%s)"
+
+    SQL_GET_USERS_GROUP_IDS = r"SELECT user_id, group_id FROM phpbb_user_group WHERE user_id IN (%s)"
+
+    SQL_ADD_USER_GROUPS = r"INSERT INTO phpbb_user_group (group_id, user_id, user_pending) VALUES %s"
+
+    SQL_REMOVE_USER_GROUPS = r"DELETE FROM phpbb_user_group WHERE user_id=%%s AND group_id IN (%s)"
+
+    SQL_CLEAR_USERS_PERMISSIONS = r"UPDATE phpbb_users SET user_permissions = '' WHERE user_id IN (%s)"
+
+    # seconds the group name -> id map is reused before being refetched
+    GROUP_CACHE_TTL = 60 * 5
+    # rows per multi-row statement
+    BULK_SIZE = 500
+
+    # (fetched at, {group name: group id})
+    group_cache = None
+
     def __init__(self):
         pass
 
@@ -52,9 +73,9 @@ class Phpbb3Manager:
     def __add_avatar(username, characterid):
         logger.debug("Adding EVE character id %s portrait as phpbb avater for user %s" % (characterid, username))
         avatar_url = "https://image.eveonline.com/Character/" + characterid + "_64.jpg"
-        cursor = connections['phpbb3'].cursor()
         userid = Phpbb3Manager.__get_user_id(username)
-        cursor.execute(Phpbb3Manager.SQL_ADD_USER_AVATAR, [avatar_url, userid])
+        with service_cursor('phpbb3') as cursor:
+            cursor.execute(Phpbb3Manager.SQL_ADD_USER_AVATAR, [avatar_url, userid])
 
     @staticmethod
     def __generate_random_pass():
@@ -72,18 +93,18 @@ class Phpbb3Manager:
     @staticmethod
     def __get_group_id(groupname):
         logger.debug("Getting phpbb3 group id for groupname %s" % groupname)
-        cursor = connections['phpbb3'].cursor()
-        cursor.execute(Phpbb3Manager.SQL_GET_GROUP_ID, [groupname])
-        row = cursor.fetchone()
+        with service_cursor('phpbb3') as cursor:
+            cursor.execute(Phpbb3Manager.SQL_GET_GROUP_ID, [groupname])
+            row = cursor.fetchone()
         logger.debug("Got phpbb group id %s for groupname %s" % (row[0], groupname))
         return row[0]
 
     @staticmethod
     def __get_user_id(username):
         logger.debug("Getting phpbb3 user id for username %s" % username)
-        cursor = connections['phpbb3'].cursor()
-        cursor.execute(Phpbb3Manager.SQL_USER_ID_FROM_USERNAME, [username])
-        row = cursor.fetchone()
+        with service_cursor('phpbb3') as cursor:
+            cursor.execute(Phpbb3Manager.SQL_USER_ID_FROM_USERNAME, [username])
+            row = cursor.fetchone()
         if row is not None:
             logger.debug("Got phpbb user id %s for username %s" % (row[0], username))
             return row[0]
@@ -92,23 +113,37 @@ class Phpbb3Manager:
             return None
 
     @staticmethod
-    def __get_all_groups():
+    def __get_all_groups(refresh=False):
+        cached = Phpbb3Manager.group_cache
+        if not refresh and cached and cached[0] + Phpbb3Manager.GROUP_CACHE_TTL > time.time():
+            return dict(cached[1])
         logger.debug("Getting all phpbb3 groups.")
-        cursor = connections['phpbb3'].cursor()
-        cursor.execute(Phpbb3Manager.SQL_GET_ALL_GROUPS)
-        rows = cursor.fetchall()
+        with service_cursor('phpbb3') as cursor:
+            cursor.execute(Phpbb3Manager.SQL_GET_ALL_GROUPS)
+            rows = cursor.fetchall()
         out = {}
         for row in rows:
             out[row[1]] = row[0]
         logger.debug("Got phpbb groups %s" % out)
-        return out
+        Phpbb3Manager.group_cache = (time.time(), out)
+        return dict(out)
+
+    @staticmethod
+    def __placeholders(count):
+        return ", ".join(["%s"] * count)
+
+    @staticmethod
+    def __chunks(items):
+        items = list(items)
+        for i in range(0, len(items), Phpbb3Manager.BULK_SIZE):
+            yield items[i:i + Phpbb3Manager.BULK_SIZE]
 
     @staticmethod
     def __get_user_groups(userid):
         logger.debug("Getting phpbb3 user id %s groups" % userid)
-        cursor = connections['phpbb3'].cursor()
-        cursor.execute(Phpbb3Manager.SQL_GET_USER_GROUPS, [userid])
-        out = [row[0] for row in cursor.fetchall()]
+        with service_cursor('phpbb3') as cursor:
+            cursor.execute(Phpbb3Manager.SQL_GET_USER_GROUPS, [userid])
+            out = [row[0] for row in cursor.fetchall()]
         logger.debug("Got user %s phpbb groups %s" % (userid, out))
         return out
 
@@ -121,19 +156,22 @@ class Phpbb3Manager:
     @staticmethod
     def __create_group(groupname):
         logger.debug("Creating phpbb3 group %s" % groupname)
-        cursor = connections['phpbb3'].cursor()
-        cursor.execute(Phpbb3Manager.SQL_ADD_GROUP, [groupname, groupname])
+        with service_cursor('phpbb3') as cursor:
+            cursor.execute(Phpbb3Manager.SQL_ADD_GROUP, [groupname, groupname])
         logger.info("Created phpbb group %s" % groupname)
-        return Phpbb3Manager.__get_group_id(groupname)
+        groupid = Phpbb3Manager.__get_group_id(groupname)
+        if Phpbb3Manager.group_cache:
+            Phpbb3Manager.group_cache[1][groupname] = groupid
+        return groupid
 
     @staticmethod
     def __add_user_to_group(userid, groupid):
         logger.debug("Adding phpbb3 user id %s to group id %s" % (userid, groupid))
         try:
-            cursor = connections['phpbb3'].cursor()
-            cursor.execute(Phpbb3Manager.SQL_ADD_USER_GROUP, [groupid, userid, 0])
-            cursor.execute(Phpbb3Manager.SQL_CLEAR_USER_PERMISSIONS, [userid])
-            logger.info("Added phpbb user id %s to group id %s" % (userid, groupid))
+            with service_cursor('phpbb3') as cursor:
+                cursor.execute(Phpbb3Manager.SQL_ADD_USER_GROUP, [groupid, userid, 0])
+                cursor.execute(Phpbb3Manager.SQL_CLEAR_USER_PERMISSIONS, [userid])
+                logger.info("Added phpbb user id %s to group id %s" % (userid, groupid))
         except:
             logger.exception("Unable to add phpbb user id %s to group id %s" % (userid, groupid))
             pass
@@ -142,10 +180,10 @@ class Phpbb3Manager:
     def __remove_user_from_group(userid, groupid):
         logger.debug("Removing phpbb3 user id %s from group id %s" % (userid, groupid))
         try:
-            cursor = connections['phpbb3'].cursor()
-            cursor.execute(Phpbb3Manager.SQL_REMOVE_USER_GROUP, [userid, groupid])
-            cursor.execute(Phpbb3Manager.SQL_CLEAR_USER_PERMISSIONS, [userid])
-            logger.info("Removed phpbb user id %s from group id %s" % (userid, groupid))
+            with service_cursor('phpbb3') as cursor:
+                cursor.execute(Phpbb3Manager.SQL_REMOVE_USER_GROUP, [userid, groupid])
+                cursor.execute(Phpbb3Manager.SQL_CLEAR_USER_PERMISSIONS, [userid])
+                logger.info("Removed phpbb user id %s from group id %s" % (userid, groupid))
         except:
             logger.exception("Unable to remove phpbb user id %s from group id %s" % (userid, groupid))
             pass
@@ -153,7 +191,6 @@ class Phpbb3Manager:
     @staticmethod
     def add_user(username, email, groups, characterid):
         logger.debug("Adding phpbb user with username %s, email %s, groups %s, characterid %s" % (username, email, groups, characterid))
-        cursor = connections['phpbb3'].cursor()
 
         username_santatized = Phpbb3Manager.__santatize_username(username)
         username_clean = username_santatized.lower()
@@ -166,15 +203,18 @@ class Phpbb3Manager:
             Phpbb3Manager.__update_user_info(username_clean, username_santatized, email, pwhash)
         else:
             try:
-
-                cursor.execute(Phpbb3Manager.SQL_ADD_USER, [username_santatized, username_clean, pwhash,
-                                                            email, 2, Phpbb3Manager.__get_current_utc_date(),
-                                                            "", ""])
-                Phpbb3Manager.update_groups(username_clean, groups)
-                Phpbb3Manager.__add_avatar(username_clean, characterid)
+                # the user, its groups and avatar are written in one transaction
+                with service_cursor('phpbb3', atomic=True) as cursor:
+                    cursor.execute(Phpbb3Manager.SQL_ADD_USER, [username_santatized, username_clean, pwhash,
+                                                                email, 2, Phpbb3Manager.__get_current_utc_date(),
+                                                                "", ""])
+                    Phpbb3Manager.update_groups(username_clean, groups)
+                    Phpbb3Manager.__add_avatar(username_clean, characterid)
                 logger.info("Added phpbb user %s" % username_clean)
             except:
                 logger.exception("Unable to add phpbb user %s" % username_clean)
+                # groups created inside the rolled back transaction are gone too
+                Phpbb3Manager.group_cache = None
                 pass
 
         return username_clean, password
@@ -182,17 +222,17 @@ class Phpbb3Manager:
     @staticmethod
     def disable_user(username):
         logger.debug("Disabling phpbb user %s" % username)
-        cursor = connections['phpbb3'].cursor()
 
         password = Phpbb3Manager.__gen_hash(Phpbb3Manager.__generate_random_pass())
         revoke_email = "revoked@" + settings.DOMAIN
         try:
-            pwhash = Phpbb3Manager.__gen_hash(password)
-            cursor.execute(Phpbb3Manager.SQL_DIS_USER, [revoke_email, pwhash, username])
-            userid = Phpbb3Manager.__get_user_id(username)
-            cursor.execute(Phpbb3Manager.SQL_DEL_AUTOLOGIN, [userid])
-            cursor.execute(Phpbb3Manager.SQL_DEL_SESSION, [userid])
-            Phpbb3Manager.update_groups(username, [])
+            with service_cursor('phpbb3', atomic=True) as cursor:
+                pwhash = Phpbb3Manager.__gen_hash(password)
+                cursor.execute(Phpbb3Manager.SQL_DIS_USER, [revoke_email, pwhash, username])
+                userid = Phpbb3Manager.__get_user_id(username)
+                cursor.execute(Phpbb3Manager.SQL_DEL_AUTOLOGIN, [userid])
+                cursor.execute(Phpbb3Manager.SQL_DEL_SESSION, [userid])
+                Phpbb3Manager.update_groups(username, [])
             logger.info("Disabled phpbb user %s" % username)
             return True
         except TypeError as e:
@@ -202,10 +242,10 @@ class Phpbb3Manager:
     @staticmethod
     def delete_user(username):
         logger.debug("Deleting phpbb user %s" % username)
-        cursor = connections['phpbb3'].cursor()
 
         if Phpbb3Manager.check_user(username):
-            cursor.execute(Phpbb3Manager.SQL_DEL_USER, [username])
+            with service_cursor('phpbb3') as cursor:
+                cursor.execute(Phpbb3Manager.SQL_DEL_USER, [username])
             logger.info("Deleted phpbb user %s" % username)
             return True
         logger.error("Unable to delete phpbb user %s - user not found on phpbb." % username)
@@ -213,27 +253,78 @@ class Phpbb3Manager:
 
     @staticmethod
     def update_groups(username, groups):
-        userid = Phpbb3Manager.__get_user_id(username)
-        logger.debug("Updating phpbb user %s with id %s groups %s" % (username, userid, groups))
-        if userid is not None:
+        logger.debug("Updating phpbb user %s groups %s" % (username, groups))
+        Phpbb3Manager.update_groups_bulk({username: groups})
+
+    @staticmethod
+    def update_groups_bulk(user_groups):
+        # user_groups maps username -> group names. Memberships are read for all
+        # users at once and every change is written in one transaction.
+        logger.debug("Bulk updating phpbb groups for %s users" % len(user_groups))
+        with service_cursor('phpbb3') as cursor:
+            # phpbb matches on username_clean, map the rows back to the names we were given
+            usernames = dict((username.lower(), username) for username in user_groups)
+            userids = {}
+            for chunk in Phpbb3Manager.__chunks(usernames):
+                cursor.execute(Phpbb3Manager.SQL_USER_IDS_FROM_USERNAMES % Phpbb3Manager.__placeholders(len(chunk)), chunk)
+                for userid, username_clean in cursor.fetchall():
+                    username = usernames.get(username_clean.lower())
+                    if username is None:
+                        logger.warn("Ignoring unexpected phpbb user %s in bulk group update." % username_clean)
+                        continue
+                    userids[username] = userid
+            for username in set(user_groups) - set(userids):
+                logger.error("Username %s not found on phpbb. Unable to update groups." % username)
+            if not userids:
+                return []
+
+            current = dict((userid, set()) for userid in userids.values())
+            for chunk in Phpbb3Manager.__chunks(current):
+                cursor.execute(Phpbb3Manager.SQL_GET_USERS_GROUP_IDS % Phpbb3Manager.__placeholders(len(chunk)), chunk)
+                for userid, groupid in cursor.fetchall():
+                    current[userid].add(groupid)
             forum_groups = Phpbb3Manager.__get_all_groups()
-            user_groups = set(Phpbb3Manager.__get_user_groups(userid))
-            act_groups = set([g.replace(' ', '-') for g in groups])
-            addgroups = act_groups - user_groups
-            remgroups = user_groups - act_groups
-            logger.info("Updating phpbb user %s groups - adding %s, removing %s" % (username, addgroups, remgroups))
-            for g in addgroups:
-                if not g in forum_groups:
-                    forum_groups[g] = Phpbb3Manager.__create_group(g)
-                Phpbb3Manager.__add_user_to_group(userid, forum_groups[g])
-
-            for g in remgroups:
-                Phpbb3Manager.__remove_user_from_group(userid, forum_groups[g])
+            if any(groupid not in forum_groups.values() for groupids in current.values() for groupid in groupids):
+                forum_groups = Phpbb3Manager.__get_all_groups(refresh=True)
+            group_names = dict((groupid, name) for name, groupid in forum_groups.items())
+
+            adds = []
+            removes = {}
+            changed = []
+            for username, userid in userids.items():
+                user_groups_set = set(group_names[g] for g in current[userid] if g in group_names)
+                act_groups = set([g.replace(' ', '-') for g in user_groups[username]])
+                addgroups = act_groups - user_groups_set
+                remgroups = user_groups_set - act_groups
+                if not addgroups and not remgroups:
+                    continue
+                logger.info("Updating phpbb user %s groups - adding %s, removing %s" % (username, addgroups, remgroups))
+                for g in addgroups:
+                    if not g in forum_groups:
+                        forum_groups[g] = Phpbb3Manager.__create_group(g)
+                    adds.append((forum_groups[g], userid, 0))
+                if remgroups:
+                    removes[userid] = [forum_groups[g] for g in remgroups]
+                changed.append(username)
+
+            if changed:
+                with transaction.atomic(using='phpbb3'):
+                    for chunk in Phpbb3Manager.__chunks(adds):
+                        cursor.execute(Phpbb3Manager.SQL_ADD_USER_GROUPS % ", ".join(["(%s, %s, %s)"] * len(chunk)),
+                                       [value for row in chunk for value in row])
+                    for userid, groupids in removes.items():
+                        cursor.execute(Phpbb3Manager.SQL_REMOVE_USER_GROUPS % Phpbb3Manager.__placeholders(len(groupids)),
+                                       [userid] + groupids)
+                    # phpbb rebuilds the cached permissions of these users on their next page load
+                    for chunk in Phpbb3Manager.__chunks(userids[username] for username in changed):
+                        cursor.execute(Phpbb3Manager.SQL_CLEAR_USERS_PERMISSIONS % Phpbb3Manager.__placeholders(len(chunk)), chunk)
+            logger.info("Updated phpbb groups for %s of %s users: %s memberships added, %s removed." % (
+                len(changed), len(userids), len(adds), sum(len(g) for g in removes.values())))
+            return changed
 
     @staticmethod
     def remove_group(username, group):
         logger.debug("Removing phpbb user %s from group %s" % (username, group))
-        cursor = connections['phpbb3'].cursor()
         userid = Phpbb3Manager.__get_user_id(username)
         if userid is not None:
             groupid = Phpbb3Manager.__get_group_id(group)
@@ -241,7 +332,8 @@ class Phpbb3Manager:
             if userid:
                 if groupid:
                     try:
-                        cursor.execute(Phpbb3Manager.SQL_REMOVE_USER_GROUP, [userid, groupid])
+                        with service_cursor('phpbb3') as cursor:
+                            cursor.execute(Phpbb3Manager.SQL_REMOVE_USER_GROUP, [userid, groupid])
                         logger.info("Removed phpbb user %s from group %s" % (username, group))
                     except:
                         logger.exception("Exception prevented removal of phpbb user %s with id %s from group %s with id %s" % (username, userid, group, groupid))
@@ -250,9 +342,9 @@ class Phpbb3Manager:
     @staticmethod
     def check_user(username):
         logger.debug("Checking phpbb username %s" % username)
-        cursor = connections['phpbb3'].cursor()
-        cursor.execute(Phpbb3Manager.SQL_USER_ID_FROM_USERNAME, [Phpbb3Manager.__santatize_username(username)])
-        row = cursor.fetchone()
+        with service_cursor('phpbb3') as cursor:
+            cursor.execute(Phpbb3Manager.SQL_USER_ID_FROM_USERNAME, [Phpbb3Manager.__santatize_username(username)])
+            row = cursor.fetchone()
         if row:
             logger.debug("Found user %s on phpbb" % username)
             return True
@@ -262,14 +354,14 @@ class Phpbb3Manager:
     @staticmethod
     def update_user_password(username, characterid, password=None):
         logger.debug("Updating phpbb user %s password" % username)
-        cursor = connections['phpbb3'].cursor()
         if not password:
             password = Phpbb3Manager.__generate_random_pass()
         if Phpbb3Manager.check_user(username):
             pwhash = Phpbb3Manager.__gen_hash(password)
             logger.debug("Proceeding to update phpbb user %s password with pwhash starting with %s" % (username, pwhash[0:5]))
-            cursor.execute(Phpbb3Manager.SQL_UPDATE_USER_PASSWORD, [pwhash, username])
-            Phpbb3Manager.__add_avatar(username, characterid)
+            with service_cursor('phpbb3', atomic=True) as cursor:
+                cursor.execute(Phpbb3Manager.SQL_UPDATE_USER_PASSWORD, [pwhash, username])
+                Phpbb3Manager.__add_avatar(username, characterid)
             logger.info("Updated phpbb user %s password." % username)
             return password
         logger.error("Unable to update phpbb user %s password - user not found on phpbb." % username)
@@ -278,9 +370,9 @@ class Phpbb3Manager:
     @staticmethod
     def __update_user_info(username_clean, username_santatized, email, password):
         logger.debug("Updating phpbb user %s info: username %s password of length %s" % (username_clean, email, len(password)))
-        cursor = connections['phpbb3'].cursor()
         try:
-            cursor.execute(Phpbb3Manager.SQL_DIS_USER, [email, password, username_santatized, username_clean])
+            with service_cursor('phpbb3') as cursor:
+                cursor.execute(Phpbb3Manager.SQL_DIS_USER, [email, password, username_santatized, username_clean])
             logger.info("Updated phpbb user %s info" % username_clean)
         except:
             logger.exception("Unable to update phpbb user %s info." % username_clean)
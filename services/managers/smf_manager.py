@@ -1,12 +1,15 @@
 import os
+import time
 import calendar
 from datetime import datetime
 import hashlib
 import logging
 
-from django.db import connections
+from django.db import transaction
 from django.conf import settings
 
+from services.managers.util.db import service_cursor
+
 logger = logging.getLogger(__name__)
 
 class smfManager:
@@ -36,7 +39,17 @@ class smfManager:
 
     SQL_ADD_USER_AVATAR = r"UPDATE smf_members SET avatar = %s WHERE id_member = %s"
 
+    SQL_GET_USERS_GROUPS = r"SELECT id_member, member_name, additional_groups FROM smf_members WHERE member_name IN (%s)"
+
+    SQL_SET_USERS_GROUPS = r"UPDATE smf_members SET additional_groups = CASE id_member %s END WHERE id_member IN (%s)"
+
+    # seconds the group name -> id map is reused before being refetched
+    GROUP_CACHE_TTL = 60 * 5
+    # rows per bulk statement
+    BULK_SIZE = 500
 
+    # (fetched at, {group name: group id})
+    group_cache = None
 
     @staticmethod
     def generate_random_pass():
@@ -60,27 +73,30 @@ class smfManager:
     @staticmethod
     def create_group(groupname):
         logger.debug("Creating smf group %s" % groupname)
-        cursor = connections['smf'].cursor()
-        cursor.execute(smfManager.SQL_ADD_GROUP, [groupname, groupname])
+        with service_cursor('smf') as cursor:
+            cursor.execute(smfManager.SQL_ADD_GROUP, [groupname, groupname])
         logger.info("Created smf group %s" % groupname)
-        return smfManager.get_group_id(groupname)
+        groupid = smfManager.get_group_id(groupname)
+        if smfManager.group_cache:
+            smfManager.group_cache[1][groupname] = groupid
+        return groupid
 
 
     @staticmethod
     def get_group_id(groupname):
         logger.debug("Getting smf group id for groupname %s" % groupname)
-        cursor = connections['smf'].cursor()
-        cursor.execute(smfManager.SQL_GET_GROUP_ID, [groupname])
-        row = cursor.fetchone()
+        with service_cursor('smf') as cursor:
+            cursor.execute(smfManager.SQL_GET_GROUP_ID, [groupname])
+            row = cursor.fetchone()
         logger.debug("Got smf group id %s for groupname %s" % (row[0], groupname))
         return row[0]
 
     @staticmethod
     def check_user(username):
         logger.debug("Checking smf username %s" % username)
-        cursor = connections['smf'].cursor()
-        cursor.execute(smfManager.SQL_USER_ID_FROM_USERNAME, [smfManager.santatize_username(username)])
-        row = cursor.fetchone()
+        with service_cursor('smf') as cursor:
+            cursor.execute(smfManager.SQL_USER_ID_FROM_USERNAME, [smfManager.santatize_username(username)])
+            row = cursor.fetchone()
         if row:
             logger.debug("Found user %s on smf" % username)
             return True
@@ -92,16 +108,16 @@ class smfManager:
     def add_avatar(member_name, characterid):
         logger.debug("Adding EVE character id %s portrait as smf avatar for user %s" % (characterid, member_name))
         avatar_url = "https://image.eveonline.com/Character/" + characterid + "_64.jpg"
-        cursor = connections['smf'].cursor()
         id_member = smfManager.get_user_id(member_name)
-        cursor.execute(smfManager.SQL_ADD_USER_AVATAR, [avatar_url, id_member])
+        with service_cursor('smf') as cursor:
+            cursor.execute(smfManager.SQL_ADD_USER_AVATAR, [avatar_url, id_member])
 
     @staticmethod
     def get_user_id(username):
         logger.debug("Getting smf user id for username %s" % username)
-        cursor = connections['smf'].cursor()
-        cursor.execute(smfManager.SQL_USER_ID_FROM_USERNAME, [username])
-        row = cursor.fetchone()
+        with service_cursor('smf') as cursor:
+            cursor.execute(smfManager.SQL_USER_ID_FROM_USERNAME, [username])
+            row = cursor.fetchone()
         if row is not None:
             logger.debug("Got smf user id %s for username %s" % (row[0], username))
             return row[0]
@@ -110,30 +126,39 @@ class smfManager:
             return None
 
     @staticmethod
-    def get_all_groups():
+    def get_all_groups(refresh=False):
+        cached = smfManager.group_cache
+        if not refresh and cached and cached[0] + smfManager.GROUP_CACHE_TTL > time.time():
+            return dict(cached[1])
         logger.debug("Getting all smf groups.")
-        cursor = connections['smf'].cursor()
-        cursor.execute(smfManager.SQL_GET_ALL_GROUPS)
-        rows = cursor.fetchall()
+        with service_cursor('smf') as cursor:
+            cursor.execute(smfManager.SQL_GET_ALL_GROUPS)
+            rows = cursor.fetchall()
         out = {}
         for row in rows:
             out[row[1]] = row[0]
         logger.debug("Got smf groups %s" % out)
-        return out
+        smfManager.group_cache = (time.time(), out)
+        return dict(out)
+
+    @staticmethod
+    def chunks(items):
+        items = list(items)
+        for i in range(0, len(items), smfManager.BULK_SIZE):
+            yield items[i:i + smfManager.BULK_SIZE]
 
     @staticmethod
     def get_user_groups(userid):
         logger.debug("Getting smf user id %s groups" % userid)
-        cursor = connections['smf'].cursor()
-        cursor.execute(smfManager.SQL_GET_USER_GROUPS, [userid])
-        out = [row[0] for row in cursor.fetchall()]
+        with service_cursor('smf') as cursor:
+            cursor.execute(smfManager.SQL_GET_USER_GROUPS, [userid])
+            out = [row[0] for row in cursor.fetchall()]
         logger.debug("Got user %s smf groups %s" % (userid, out))
         return out
 
     @staticmethod
     def add_user(username, email_address, groups, characterid):
         logger.debug("Adding smf user with member_name %s, email_address %s, characterid %s" % (username, email_address, characterid))
-        cursor = connections['smf'].cursor()
         username_clean = smfManager.santatize_username(username)
         passwd = smfManager.generate_random_pass()
         pwhash = smfManager.gen_hash(username_clean, passwd)
@@ -145,21 +170,25 @@ class smfManager:
             smfManager.__update_user_info(username_clean, email_address, pwhash)
         else:
             try:
-                cursor.execute(smfManager.SQL_ADD_USER, [username_clean, passwd, email_address, register_date, username_clean])
-                smfManager.add_avatar(username_clean, characterid)
+                # the member, its avatar and groups are written in one transaction
+                with service_cursor('smf', atomic=True) as cursor:
+                    cursor.execute(smfManager.SQL_ADD_USER, [username_clean, passwd, email_address, register_date, username_clean])
+                    smfManager.add_avatar(username_clean, characterid)
+                    smfManager.update_groups(username_clean, groups)
                 logger.info("Added smf member_name %s" % username_clean)
-                smfManager.update_groups(username_clean, groups)
             except:
                 logger.warn("Unable to add smf user %s" % username_clean)
+                # groups created inside the rolled back transaction are gone too
+                smfManager.group_cache = None
                 pass
         return username_clean, passwd
 
     @staticmethod
     def __update_user_info(username, email_address, passwd):
         logger.debug("Updating smf user %s info: username %s password of length %s" % (username, email_address, len(passwd)))
-        cursor = connections['smf'].cursor()
         try:
-            cursor.execute(smfManager.SQL_DIS_USER, [email_address, passwd, username])
+            with service_cursor('smf') as cursor:
+                cursor.execute(smfManager.SQL_DIS_USER, [email_address, passwd, username])
             logger.info("Updated smf user %s info" % username)
         except:
             logger.exception("Unable to update smf user %s info." % username)
@@ -168,10 +197,10 @@ class smfManager:
     @staticmethod
     def delete_user(username):
         logger.debug("Deleting smf user %s" % username)
-        cursor = connections['smf'].cursor()
 
         if smfManager.check_user(username):
-            cursor.execute(smfManager.SQL_DEL_USER, [username])
+            with service_cursor('smf') as cursor:
+                cursor.execute(smfManager.SQL_DEL_USER, [username])
             logger.info("Deleted smf user %s" % username)
             return True
         logger.error("Unable to delete smf user %s - user not found on smf." % username)
@@ -179,30 +208,52 @@ class smfManager:
 
     @staticmethod
     def update_groups(username, groups):
-        userid = smfManager.get_user_id(username)
-        logger.debug("Updating smf user %s with id %s groups %s" % (username, userid, groups))
-        if userid is not None:
+        logger.debug("Updating smf user %s groups %s" % (username, groups))
+        smfManager.update_groups_bulk({username: groups})
+
+    @staticmethod
+    def update_groups_bulk(user_groups):
+        # user_groups maps member_name -> group names. Each member's final
+        # additional_groups string is computed here and only changed rows are written.
+        logger.debug("Bulk updating smf groups for %s users" % len(user_groups))
+        with service_cursor('smf') as cursor:
+            members = {}
+            for chunk in smfManager.chunks(user_groups):
+                cursor.execute(smfManager.SQL_GET_USERS_GROUPS % ", ".join(["%s"] * len(chunk)), chunk)
+                for userid, username, additional_groups in cursor.fetchall():
+                    members[username] = (userid, additional_groups or "")
+            for username in set(user_groups) - set(members):
+                logger.error("username %s not found on smf. Unable to update groups." % username)
+
             forum_groups = smfManager.get_all_groups()
-            user_groups = set(smfManager.get_user_groups(userid))
-            act_groups = set([g.replace(' ', '-') for g in groups])
-            addgroups = act_groups - user_groups
-            remgroups = user_groups - act_groups
-            logger.info("Updating smf user %s groups - adding %s, removing %s" % (username, addgroups, remgroups))
-            act_group_id = set()
-            for g in addgroups:
-                if not g in forum_groups:
-                    forum_groups[g] = smfManager.create_group(g)
-                act_group_id.add(str(smfManager.get_group_id(g)))
-            string_groups = ','.join(act_group_id)
-            smfManager.add_user_to_group(userid, string_groups)
+            updates = []
+            for username, (userid, additional_groups) in members.items():
+                act_group_id = set()
+                for g in set([g.replace(' ', '-') for g in user_groups[username]]):
+                    if not g in forum_groups:
+                        forum_groups[g] = smfManager.create_group(g)
+                    act_group_id.add(str(forum_groups[g]))
+                if act_group_id != set(filter(None, additional_groups.split(','))):
+                    logger.info("Updating smf user %s groups to %s" % (username, act_group_id))
+                    updates.append((userid, ','.join(sorted(act_group_id, key=int))))
+
+            if updates:
+                with transaction.atomic(using='smf'):
+                    for chunk in smfManager.chunks(updates):
+                        cursor.execute(smfManager.SQL_SET_USERS_GROUPS % (" ".join(["WHEN %s THEN %s"] * len(chunk)),
+                                                                          ", ".join(["%s"] * len(chunk))),
+                                       [value for row in chunk for value in row] + [row[0] for row in chunk])
+        logger.info("Updated smf groups for %s of %s users." % (len(updates), len(members)))
+        updated_ids = set(row[0] for row in updates)
+        return [username for username, (userid, additional_groups) in members.items() if userid in updated_ids]
 
 
     @staticmethod
     def add_user_to_group(userid, groupid):
         logger.debug("Adding smf user id %s to group id %s" % (userid, groupid))
         try:
-            cursor = connections['smf'].cursor()
-            cursor.execute(smfManager.SQL_ADD_USER_GROUP, [groupid, userid])
+            with service_cursor('smf') as cursor:
+                cursor.execute(smfManager.SQL_ADD_USER_GROUP, [groupid, userid])
             logger.info("Added smf user id %s to group id %s" % (userid, groupid))
         except:
             logger.exception("Unable to add smf user id %s to group id %s" % (userid, groupid))
@@ -212,8 +263,8 @@ class smfManager:
     def remove_user_from_group(userid, groupid):
         logger.debug("Removing smf user id %s from group id %s" % (userid, groupid))
         try:
-            cursor = connections['smf'].cursor()
-            cursor.execute(smfManager.SQL_REMOVE_USER_GROUP, [groupid, userid])
+            with service_cursor('smf') as cursor:
+                cursor.execute(smfManager.SQL_REMOVE_USER_GROUP, [groupid, userid])
             logger.info("Removed smf user id %s from group id %s" % (userid, groupid))
         except:
             logger.exception("Unable to remove smf user id %s from group id %s" % (userid, groupid))
@@ -222,15 +273,15 @@ class smfManager:
     @staticmethod
     def disable_user(username):
         logger.debug("Disabling smf user %s" % username)
-        cursor = connections['smf'].cursor()
 
         password = smfManager.generate_random_pass()
         revoke_email = "revoked@" + settings.DOMAIN
         try:
             pwhash = smfManager.gen_hash(username, password)
-            cursor.execute(smfManager.SQL_DIS_USER, [revoke_email, pwhash, username])
-            userid = smfManager.get_user_id(username)
-            smfManager.update_groups(username, [])
+            with service_cursor('smf', atomic=True) as cursor:
+                cursor.execute(smfManager.SQL_DIS_USER, [revoke_email, pwhash, username])
+                userid = smfManager.get_user_id(username)
+                smfManager.update_groups(username, [])
             logger.info("Disabled smf user %s" % username)
             return True
         except TypeError as e:
@@ -240,15 +291,15 @@ class smfManager:
     @staticmethod
     def update_user_password(username, characterid, password=None):
         logger.debug("Updating smf user %s password" % username)
-        cursor = connections['smf'].cursor()
         if not password:
             password = smfManager.generate_random_pass()
         if smfManager.check_user(username):
             username_clean = smfManager.santatize_username(username)
             pwhash = smfManager.gen_hash(username_clean, password)
             logger.debug("Proceeding to update smf user %s password with pwhash starting with %s" % (username, pwhash[0:5]))
-            cursor.execute(smfManager.SQL_UPDATE_USER_PASSWORD, [pwhash, username])
-            smfManager.add_avatar(username, characterid)
+            with service_cursor('smf', atomic=True) as cursor:
+                cursor.execute(smfManager.SQL_UPDATE_USER_PASSWORD, [pwhash, username])
+                smfManager.add_avatar(username, characterid)
             logger.info("Updated smf user %s password." % username)
             return password
         logger.error("Unable to update smf user %s password - user not found on smf." % username)
@@ -1,22 +1,33 @@
 from django.conf import settings
 
-from services.managers.util.ts3 import TS3Server
+from services.managers.util.ts3 import TS3ServerPool
 from services.models import TSgroup
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 class Teamspeak3Manager:
+    # seconds the server group name -> id index is reused before being refetched
+    GROUP_INDEX_TTL = 60 * 5
+
+    # logged in serverquery connections reused between calls
+    pool = None
+    # (fetched at, {group name: group id}) for the virtual server
+    group_index = None
+
     def __init__(self):
         pass
 
     @staticmethod
     def __get_created_server():
-        server = TS3Server(settings.TEAMSPEAK3_SERVER_IP, settings.TEAMSPEAK3_SERVER_PORT)
-        server.login(settings.TEAMSPEAK3_SERVERQUERY_USER, settings.TEAMSPEAK3_SERVERQUERY_PASSWORD)
-        server.use(settings.TEAMSPEAK3_VIRTUAL_SERVER)
-        logger.debug("Got TS3 server instance based on settings.")
-        return server
+        if Teamspeak3Manager.pool is None:
+            Teamspeak3Manager.pool = TS3ServerPool(settings.TEAMSPEAK3_SERVER_IP, settings.TEAMSPEAK3_SERVER_PORT,
+                                                   settings.TEAMSPEAK3_SERVERQUERY_USER,
+                                                   settings.TEAMSPEAK3_SERVERQUERY_PASSWORD,
+                                                   settings.TEAMSPEAK3_VIRTUAL_SERVER)
+            logger.debug("Created TS3 connection pool based on settings.")
+        return Teamspeak3Manager.pool
 
     @staticmethod
     def __santatize_username(username):
@@ -43,15 +54,14 @@ class Teamspeak3Manager:
 
     @staticmethod
     def _group_id_by_name(groupname):
-        server = Teamspeak3Manager.__get_created_server()
         logger.debug("Looking for group %s on TS3 server." % groupname)
-        group_cache = server.send_command('servergrouplist')
-        logger.debug("Received group cache from server: %s" % group_cache)
-        for group in group_cache:
-            logger.debug("Checking group %s" % group)
-            if group['keys']['name'] == groupname:
-                logger.debug("Found group %s, returning id %s" % (groupname, group['keys']['sgid']))
-                return group['keys']['sgid']
+        groups = Teamspeak3Manager._group_list()
+        if groupname not in groups:
+            logger.debug("Group %s not in cached group index. Refreshing." % groupname)
+            groups = Teamspeak3Manager._group_list(refresh=True)
+        if groupname in groups:
+            logger.debug("Found group %s, returning id %s" % (groupname, groups[groupname]))
+            return groups[groupname]
         logger.debug("Group %s not found on server." % groupname)
         return None
 
@@ -63,8 +73,9 @@ class Teamspeak3Manager:
         if not sgid:
             logger.debug("Group does not yet exist. Proceeding with creation.")
             ret = server.send_command('servergroupadd', {'name': groupname})
-            Teamspeak3Manager.__group_cache = None
             sgid = ret['keys']['sgid']
+            if Teamspeak3Manager.group_index:
+                Teamspeak3Manager.group_index[1][groupname] = sgid
             server.send_command('servergroupaddperm',
                                 {'sgid': sgid, 'permsid': 'i_group_needed_modify_power', 'permvalue': 75,
                                  'permnegated': 0, 'permskip': 0})
@@ -96,7 +107,10 @@ class Teamspeak3Manager:
         return outlist
 
     @staticmethod
-    def _group_list():
+    def _group_list(refresh=False):
+        cached = Teamspeak3Manager.group_index
+        if not refresh and cached and cached[0] + Teamspeak3Manager.GROUP_INDEX_TTL > time.time():
+            return dict(cached[1])
         logger.debug("Retrieving group list on TS3 server.")
         server = Teamspeak3Manager.__get_created_server()
         group_cache = server.send_command('servergrouplist')
@@ -106,16 +120,16 @@ class Teamspeak3Manager:
             for group in group_cache:
                 logger.debug("Assigning name/id dict: %s = %s" % (group['keys']['name'], group['keys']['sgid']))
                 outlist[group['keys']['name']] = group['keys']['sgid']
+            Teamspeak3Manager.group_index = (time.time(), outlist)
         else:
             logger.error("Received empty group cache while retrieving group cache from TS3 server. 1024 error.")
         logger.debug("Returning name/id pairing: %s" % outlist)
-        return outlist
+        return dict(outlist)
 
     @staticmethod
     def _add_user_to_group(uid, groupid):
         logger.debug("Adding group id %s to TS3 user id %s" % (groupid, uid))
         server = Teamspeak3Manager.__get_created_server()
-        server_groups = Teamspeak3Manager._group_list()
         user_groups = Teamspeak3Manager._user_group_list(uid)
         
         if not groupid in user_groups.values():
@@ -128,7 +142,6 @@ class Teamspeak3Manager:
     def _remove_user_from_group(uid, groupid):
         logger.debug("Removing group id %s from TS3 user id %s" % (groupid, uid))
         server = Teamspeak3Manager.__get_created_server()
-        server_groups = Teamspeak3Manager._group_list()
         user_groups = Teamspeak3Manager._user_group_list(uid)
 
         if str(groupid) in user_groups.values():
@@ -137,11 +150,113 @@ class Teamspeak3Manager:
                                 {'sgid': str(groupid), 'cldbid': uid})
             logger.info("Removed user id %s from group id %s on TS3 server." % (uid, groupid))
 
+    @staticmethod
+    def _apply_group_command(command, sgid, cldbids):
+        server = Teamspeak3Manager.__get_created_server()
+        cldbids = [str(cldbid) for cldbid in cldbids]
+        ret = server.send_command(command, {'sgid': str(sgid), 'cldbid': cldbids})
+        if ret == '0':
+            return set(cldbids)
+        # a piped command stops at the first failing entry, retry the clients one by one
+        logger.warn("Batched %s for group %s failed with error %s. Falling back to single commands." % (command, sgid, ret))
+        applied = set()
+        for cldbid in cldbids:
+            ret = server.send_command(command, {'sgid': str(sgid), 'cldbid': cldbid})
+            if ret == '0':
+                applied.add(cldbid)
+            else:
+                logger.error("%s for client %s and group %s failed with error %s" % (command, cldbid, sgid, ret))
+        return applied
+
+    @staticmethod
+    def apply_group_changes(adds, removes):
+        # adds and removes map server group id -> client database ids,
+        # each group's changes go out as a single piped command.
+        # Returns the added and removed counts and the client ids with a failed change.
+        added = 0
+        removed = 0
+        failed = set()
+        for sgid, cldbids in adds.items():
+            if cldbids:
+                logger.info("Adding Teamspeak users %s into group %s" % (cldbids, sgid))
+                applied = Teamspeak3Manager._apply_group_command('servergroupaddclient', sgid, cldbids)
+                added += len(applied)
+                failed.update(str(cldbid) for cldbid in cldbids if str(cldbid) not in applied)
+        for sgid, cldbids in removes.items():
+            if cldbids:
+                logger.info("Removing Teamspeak users %s from group %s" % (cldbids, sgid))
+                applied = Teamspeak3Manager._apply_group_command('servergroupdelclient', sgid, cldbids)
+                removed += len(applied)
+                failed.update(str(cldbid) for cldbid in cldbids if str(cldbid) not in applied)
+        return added, removed, failed
+
+    @staticmethod
+    def _client_ids_by_uid():
+        logger.debug("Retrieving all sso_uid client ids from TS3 server.")
+        server = Teamspeak3Manager.__get_created_server()
+        ret = server.send_command('customsearch', {'ident': 'sso_uid', 'pattern': '%'})
+        if type(ret) == dict:
+            ret = [ret]
+        elif type(ret) != list:
+            logger.debug("No clients with an sso_uid found: %s" % ret)
+            return {}
+        return dict((client['keys']['value'], client['keys']['cldbid']) for client in ret)
+
+    @staticmethod
+    def _group_client_list(sgid):
+        server = Teamspeak3Manager.__get_created_server()
+        ret = server.send_command('servergroupclientlist', {'sgid': str(sgid)})
+        if type(ret) == dict:
+            ret = [ret]
+        elif type(ret) != list:
+            # the server answers an empty group with an error code
+            return set()
+        return set(client['keys']['cldbid'] for client in ret)
+
+    @staticmethod
+    def reconcile_groups(expected):
+        # expected maps sso uid -> server group ids the client should hold.
+        # Membership is read once per server group and only the differences are sent.
+        server = Teamspeak3Manager.__get_created_server()
+        cldbids = Teamspeak3Manager._client_ids_by_uid()
+        uids = dict((cldbid, uid) for uid, cldbid in cldbids.items())
+        desired = {}
+        for uid, sgids in expected.items():
+            if uid in cldbids:
+                desired[cldbids[uid]] = set(str(sgid) for sgid in sgids)
+        server_groups = server.send_command('servergrouplist')
+        if type(server_groups) == dict:
+            server_groups = [server_groups]
+        elif type(server_groups) != list:
+            logger.error("Received error %s while retrieving group list from TS3 server." % server_groups)
+            return []
+        adds = {}
+        removes = {}
+        changed = set()
+        for group in server_groups:
+            # only regular groups carry members, templates and query groups are left alone
+            if group['keys'].get('type', '1') != '1':
+                continue
+            sgid = group['keys']['sgid']
+            members = Teamspeak3Manager._group_client_list(sgid)
+            for cldbid, sgids in desired.items():
+                if sgid in sgids and cldbid not in members:
+                    adds.setdefault(sgid, []).append(cldbid)
+                    changed.add(cldbid)
+                elif sgid not in sgids and cldbid in members:
+                    removes.setdefault(sgid, []).append(cldbid)
+                    changed.add(cldbid)
+        added, removed, failed = Teamspeak3Manager.apply_group_changes(adds, removes)
+        logger.info("Reconciled %s TS3 clients across %s groups: %s added, %s removed, %s clients failed." % (
+            len(desired), len(server_groups), added, removed, len(failed)))
+        # clients with a failed change keep their old snapshot so the next sync retries them
+        return [uids[cldbid] for cldbid in changed - failed]
+
     @staticmethod
     def _sync_ts_group_db():
         logger.debug("_sync_ts_group_db function called.")
         try:
-            remote_groups = Teamspeak3Manager._group_list()
+            remote_groups = Teamspeak3Manager._group_list(refresh=True)
             local_groups = TSgroup.objects.all()
             logger.debug("Comparing remote groups to TSgroup objects: %s" % local_groups)
             for key in remote_groups:
@@ -277,11 +392,10 @@ class Teamspeak3Manager:
                 if user_ts_groups[user_ts_group_key] not in ts_groups.values():
                     remgroups.append(user_ts_groups[user_ts_group_key])
 
-            for g in addgroups:
-                logger.info("Adding Teamspeak user %s into group %s" % (userid, g))
-                Teamspeak3Manager._add_user_to_group(userid, g)
-
-            for g in remgroups:
-                logger.info("Removing Teamspeak user %s from group %s" % (userid, g))
-                Teamspeak3Manager._remove_user_from_group(userid, g)
+            # membership was just read, so apply the diff without re-checking each group
+            added, removed, failed = Teamspeak3Manager.apply_group_changes(dict((g, [userid]) for g in addgroups),
+                                                                           dict((g, [userid]) for g in remgroups))
+            return not failed
+        logger.warn("Unable to update TS3 groups for uid %s: not found on server." % uid)
+        return False
 
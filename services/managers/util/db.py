@@ -0,0 +1,126 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# statements slower than this many seconds are logged as warnings
+SLOW_QUERY = 1.0
+
+# service name -> counters, shared by every cursor in this process
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def record_query(service, elapsed, error=False):
+    with _stats_lock:
+        stats = _stats.setdefault(service, {'queries': 0, 'errors': 0, 'slow': 0, 'time': 0.0, 'max': 0.0})
+        stats['queries'] += 1
+        stats['time'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        if error:
+            stats['errors'] += 1
+        if elapsed >= SLOW_QUERY:
+            stats['slow'] += 1
+
+
+def get_query_stats():
+    """
+    Query counts and latencies per service since the process started
+    @return: dict of service -> queries, errors, slow, time, max and avg (seconds)
+    """
+    with _stats_lock:
+        out = dict((service, dict(stats)) for service, stats in _stats.items())
+    for stats in out.values():
+        stats['avg'] = stats['time'] / stats['queries'] if stats['queries'] else 0.0
+    return out
+
+
+def format_query_stats(service):
+    """
+    One line summary of a service's query stats for the logs
+    @param service: Database alias of the service, e.g. phpbb3
+    @type service: str
+    """
+    stats = get_query_stats().get(service)
+    if not stats:
+        return "no queries"
+    return "%s queries, %s errors, %s slow, avg %.1fms, max %.1fms" % (
+        stats['queries'], stats['errors'], stats['slow'], stats['avg'] * 1000, stats['max'] * 1000)
+
+
+def reset_query_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+@contextmanager
+def metered(service, what):
+    # times one call against an external service and records it in the query stats
+    start = time.time()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        elapsed = time.time() - start
+        record_query(service, elapsed, error)
+        if elapsed >= SLOW_QUERY:
+            logger.warn("Slow %s query took %.3fs: %s" % (service, elapsed, what[:200]))
+
+
+class MeteredCursor():
+    def __init__(self, alias, cursor):
+        self.alias = alias
+        self.cursor = cursor
+        self.queries = 0
+        self.time = 0.0
+
+    def _run(self, method, sql, params):
+        start = time.time()
+        try:
+            with metered(self.alias, sql):
+                return method(sql, params)
+        finally:
+            self.queries += 1
+            self.time += time.time() - start
+
+    def execute(self, sql, params=None):
+        return self._run(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._run(self.cursor.executemany, sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+@contextmanager
+def service_cursor(alias, atomic=False):
+    """
+    Metered cursor on a service database, closed when the block exits
+    @param alias: Database alias of the service, e.g. phpbb3
+    @type alias: str
+    @param atomic: Run the block in one transaction. Cursors opened by helpers
+                   called inside the block join that transaction.
+    @type atomic: bool
+    """
+    if atomic:
+        with transaction.atomic(using=alias):
+            with service_cursor(alias) as cursor:
+                yield cursor
+        return
+    cursor = MeteredCursor(alias, connections[alias].cursor())
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+        if cursor.queries:
+            logger.debug("Ran %s %s queries in %.1fms" % (cursor.queries, alias, cursor.time * 1000))
@@ -1,5 +1,9 @@
+import os
+import re
 import socket
 import logging
+import threading
+import time
 
 
 class ConnectionError():
@@ -22,12 +26,32 @@ ts3_escape = {'/': r"\/",
               "\t": r'\t',
               "\v": r'\v'}
 
+# single pass escaping, every special character is looked up once
+_escape_map = dict(ts3_escape)
+_escape_map['\\'] = r'\\'
+_escape_re = re.compile('[%s]' % re.escape(''.join(_escape_map)))
+
+# single pass unescaping, so an escaped backslash followed by a letter is not unescaped twice
+_unescape_re = re.compile(r'\\(.)')
+_unescape_map = dict((j[1], i) for i, j in ts3_escape.items())
+_unescape_map['\\'] = '\\'
+
+
+def _escape_char(match):
+    return _escape_map[match.group(0)]
+
+
+def _unescape_char(match):
+    char = match.group(1)
+    return _unescape_map.get(char, char)
+
 
 class TS3Proto():
     bytesin = 0
     bytesout = 0
 
     _connected = False
+    last_error = None
 
     def __init__(self):
         self._log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
@@ -42,7 +66,7 @@ class TS3Proto():
             raise
         else:
             self._sock = s
-            self._sockfile = s.makefile('r', 0)
+            self._sockfile = s.makefile('rb')
 
         data = self._sockfile.readline()
         if data.strip() == "TS3":
@@ -57,28 +81,48 @@ class TS3Proto():
         self._connected = False
         self._log.info('Disconnected')
 
-    def send_command(self, command, keys=None, opts=None):
-        cmd = self.construct_command(command, keys=keys, opts=opts)
-        self.send('%s\n' % cmd)
+    def iter_response(self):
+        """
+        Read a reply from the server, yielding each row as soon as it is parsed
+        The closing error line is yielded last, as a dict with a 'command' key
+        """
+        while True:
+            line = self._sockfile.readline()
+            if not line:
+                # server closed the connection, readline would return '' forever
+                self._connected = False
+                raise socket.error('TS3 server closed the connection')
+            for row in line.rstrip('\r\n').split('|'):
+                resp = self._parse_row(row)
+                yield resp
+                if 'command' in resp:
+                    return
+
+    def iter_command(self, command, keys=None, opts=None):
+        """
+        Send a command and yield the rows of the reply one at a time
+        The reply's error id is left in last_error once the rows are exhausted
+        @param command: Command
+        @type command: string
+        """
+        self.last_error = None
+        self.send('%s\n' % self.construct_command(command, keys=keys, opts=opts))
+        for resp in self.iter_response():
+            if 'command' in resp:
+                self.last_error = resp['keys'].get('id')
+                return
+            yield resp
 
-        data = []
+    def send_command(self, command, keys=None, opts=None):
+        data = list(self.iter_command(command, keys=keys, opts=opts))
 
-        while True:
-            resp = self._sockfile.readline()
-            resp = self.parse_command(resp)
-            if not 'command' in resp:
-                data.append(resp)
-            else:
-                break
-
-        if resp['command'] == 'error':
-            if data and resp['keys']['id'] == '0':
-                if len(data) > 1:
-                    return data
-                else:
-                    return data[0]
+        if data and self.last_error == '0':
+            if len(data) > 1:
+                return data
             else:
-                return resp['keys']['id']
+                return data[0]
+        else:
+            return self.last_error
 
     def construct_command(self, command, keys=None, opts=None):
         """
@@ -96,14 +140,16 @@ class TS3Proto():
 
         # Add the keys and values, escape as needed        
         if keys:
+            for key in keys:
+                if not isinstance(keys[key], list):
+                    cstr.append("%s=%s" % (key, self._escape_str(keys[key])))
+            # Nested keys go last so the plain keys apply to every piped entry
             for key in keys:
                 if isinstance(keys[key], list):
                     ncstr = []
                     for nest in keys[key]:
                         ncstr.append("%s=%s" % (key, self._escape_str(nest)))
                     cstr.append("|".join(ncstr))
-                else:
-                    cstr.append("%s=%s" % (key, self._escape_str(keys[key])))
 
         # Add in options
         if opts:
@@ -119,32 +165,33 @@ class TS3Proto():
         @type commandstr: string
         """
 
-        if len(commandstr.split('|')) > 1:
-            vals = []
-            for cmd in commandstr.split('|'):
-                vals.append(self.parse_command(cmd))
-            return vals
+        rows = commandstr.strip().split('|')
+        if len(rows) > 1:
+            return [self._parse_row(row) for row in rows]
+        return self._parse_row(rows[0])
+
+    @staticmethod
+    def _parse_row(row):
+        """
+        Parses a single row of a TS3 reply into a command/keys/opts dict
+        @param row: Row without '|' separators
+        @type row: string
+        """
 
-        cmdlist = commandstr.strip().split(' ')
         command = None
         keys = {}
         opts = []
-
-        for key in cmdlist:
-            v = key.strip().split('=')
-            if len(v) > 1:
-                # Key
-                if len > 2:
-                    # Fix the stupidities in TS3 escaping
-                    v = [v[0], '='.join(v[1:])]
-                key, value = v
-                keys[key] = self._unescape_str(value)
-            elif (not v == ['']): 
-                if v[0][0] and v[0][0] == '-':
-                    # Option
-                    opts.append(v[0][1:])
-                else:
-                    command = v[0]
+        unescape = TS3Proto._unescape_str
+
+        for token in row.split():
+            key, sep, value = token.partition('=')
+            if sep:
+                # Values may themselves contain '=', only the first one separates
+                keys[key] = unescape(value)
+            elif key[0] == '-':
+                opts.append(key[1:])
+            else:
+                command = key
 
         d = {'keys': keys, 'opts': opts}
         if command:
@@ -160,10 +207,7 @@ class TS3Proto():
         """
 
         if isinstance(value, int): return "%d" % value
-        value = value.replace("\\", r'\\')
-        for i, j in ts3_escape.iteritems():
-            value = value.replace(i, j)
-        return value
+        return _escape_re.sub(_escape_char, value)
 
     @staticmethod
     def _unescape_str(value):
@@ -174,16 +218,14 @@ class TS3Proto():
         """
 
         if isinstance(value, int): return "%d" % value
-        value = value.replace(r"\\", "\\")
-        for i, j in ts3_escape.iteritems():
-            value = value.replace(j, i)
-        return value
+        if "\\" not in value: return value
+        return _unescape_re.sub(_unescape_char, value)
 
 
     def send(self, payload):
         if self._connected:
             self._log.debug('Sent: %s' % payload)
-            self._sockfile.write(payload)
+            self._sock.sendall(payload)
 
 
 class TS3Server(TS3Proto):
@@ -202,7 +244,7 @@ class TS3Server(TS3Proto):
                 self.use(id)
         else:
             self._sock = sock
-            self._sockfile = sock.makefile('r', 0)
+            self._sockfile = sock.makefile('rb')
             self._connected = True
 
     def login(self, username, password):
@@ -214,7 +256,8 @@ class TS3Server(TS3Proto):
         @type password: str
         """
         d = self.send_command('login', keys={'client_login_name': username, 'client_login_password': password})
-        if d == 0:
+        # the reply's error id comes back as a string
+        if d == '0':
             self._log.info('Login Successful')
             return True
         return False
@@ -243,3 +286,104 @@ class TS3Server(TS3Proto):
         """
         if self._connected and id > 0:
             self.send_command('use', keys={'sid': id})
+
+
+class TS3ServerPool():
+    def __init__(self, ip, port, username, password, server_id, size=4, keepalive=60):
+        """
+        Pool of logged in TS3Server connections shared between threads
+        @param size: Maximum number of connections checked out at once
+        @type size: int
+        @param keepalive: Seconds a connection may idle before it is checked with whoami
+        @type keepalive: int
+        """
+        self._log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.ip = ip
+        self.port = port
+        self.username = username
+        self.password = password
+        self.server_id = server_id
+        self.keepalive = keepalive
+        self.logins = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._pid = os.getpid()
+
+    def _connect(self):
+        server = TS3Server(self.ip, self.port)
+        if not server.login(self.username, self.password):
+            # never pool a connection that is not logged in, the caller's slot is released by checkout
+            error = server.last_error
+            self._close(server)
+            raise socket.error('TS3 login as %s failed with error id %s' % (self.username, error))
+        server.use(self.server_id)
+        self.logins += 1
+        self._log.debug('Opened new TS3 connection (%s logins so far)' % self.logins)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.disconnect()
+        except Exception:
+            if server._sock:
+                server._sock.close()
+
+    def _alive(self, server, last_used):
+        if time.time() - last_used < self.keepalive:
+            return True
+        try:
+            return isinstance(server.send_command('whoami'), dict)
+        except socket.error:
+            return False
+
+    def checkout(self):
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if self._pid != os.getpid():
+                        # connections inherited through a fork share their socket with the parent
+                        self._idle = []
+                        self._pid = os.getpid()
+                    if not self._idle:
+                        break
+                    server, last_used = self._idle.pop()
+                if self._alive(server, last_used):
+                    return server
+                self._log.debug('Discarding dead TS3 connection')
+                self._close(server)
+            return self._connect()
+        except:
+            self._slots.release()
+            raise
+
+    def checkin(self, server, discard=False):
+        try:
+            if discard:
+                self._close(server)
+            else:
+                with self._lock:
+                    self._idle.append((server, time.time()))
+        finally:
+            self._slots.release()
+
+    def send_command(self, command, keys=None, opts=None):
+        """
+        Send a command over a pooled connection, reconnecting once if it has dropped
+        """
+        for attempt in range(2):
+            server = self.checkout()
+            failed = True
+            try:
+                ret = server.send_command(command, keys=keys, opts=opts)
+                failed = False
+                return ret
+            except socket.error:
+                if attempt:
+                    raise
+                self._log.debug('TS3 connection dropped during %s, reconnecting' % command)
+            finally:
+                # the connection goes back even on unexpected errors, discarded as its state is unknown
+                self.checkin(server, discard=failed)
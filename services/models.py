@@ -43,6 +43,7 @@ class MumbleUser(models.Model):
     username = models.CharField(max_length=254, unique=True)
     pwhash = models.CharField(max_length=40)
     groups = models.TextField(blank=True, null=True)
+    updated = models.DateTimeField(auto_now=True, null=True)
 
     def __str__(self):
         return self.username
@@ -1 +1,42 @@
-# Create your tests here.
+from StringIO import StringIO
+
+from django.test import SimpleTestCase
+
+from services.managers.util.ts3 import TS3Proto, ts3_escape
+from services.ts3_benchmark import REPLIES, load_reply, original_parse_command
+
+
+class TS3EscapeTestCase(SimpleTestCase):
+    def test_escape(self):
+        self.assertEqual(TS3Proto._escape_str('a b|c/d\\e'), r'a\sb\pc\/d\\e')
+        self.assertEqual(TS3Proto._escape_str(42), '42')
+
+    def test_round_trip(self):
+        values = ['plain', '', ''.join(ts3_escape), '\\s is not a space', 'trailing\\', 'a\\\\b c']
+        for value in values:
+            self.assertEqual(TS3Proto._unescape_str(TS3Proto._escape_str(value)), value)
+
+    def test_parse_row(self):
+        row = TS3Proto._parse_row(r'clid=5 client_nickname=Bob\sthe\p\/Builder client_description=a=b -away')
+        self.assertEqual(row['keys'], {'clid': '5', 'client_nickname': 'Bob the|/Builder', 'client_description': 'a=b'})
+        self.assertEqual(row['opts'], ['away'])
+        self.assertNotIn('command', row)
+
+    def test_parse_large_reply(self):
+        names = ['Client %s|%s' % (i, i % 7) for i in range(3000)]
+        reply = '|'.join('clid=%s client_nickname=%s' % (i, TS3Proto._escape_str(name)) for i, name in enumerate(names))
+        proto = TS3Proto()
+        proto._sockfile = StringIO(reply + '\nerror id=0 msg=ok\n')
+        rows = list(proto.iter_response())
+        self.assertEqual(rows[-1]['command'], 'error')
+        self.assertEqual([row['keys']['client_nickname'] for row in rows[:-1]], names)
+
+    def test_recorded_replies(self):
+        # the streaming parser must agree with the original one on the benchmark replies
+        for name in REPLIES:
+            reply = load_reply(name)
+            proto = TS3Proto()
+            proto._sockfile = StringIO(reply)
+            rows = list(proto.iter_response())
+            self.assertEqual(rows[-1]['keys']['id'], '0')
+            self.assertEqual(rows[:-1], original_parse_command(reply.split('\n', 1)[0]))
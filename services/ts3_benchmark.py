@@ -0,0 +1,93 @@
+"""
+Times the TS3 ServerQuery escaper and parser against the original implementation
+over the replies in services/testdata. Run from the project root with
+    python -m services.ts3_benchmark
+"""
+import os
+import timeit
+from StringIO import StringIO
+
+from services.managers.util.ts3 import TS3Proto, ts3_escape
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+REPLIES = ('ts3_clientlist.txt', 'ts3_servergroupclientlist.txt')
+REPEAT = 5
+
+
+def load_reply(name):
+    with open(os.path.join(TESTDATA, name), 'rb') as f:
+        return f.read()
+
+
+# The implementation the faster parser and escaper replaced, kept for comparison
+
+def original_escape_str(value):
+    if isinstance(value, int): return "%d" % value
+    value = value.replace("\\", r'\\')
+    for i, j in ts3_escape.iteritems():
+        value = value.replace(i, j)
+    return value
+
+
+def original_unescape_str(value):
+    if isinstance(value, int): return "%d" % value
+    value = value.replace(r"\\", "\\")
+    for i, j in ts3_escape.iteritems():
+        value = value.replace(j, i)
+    return value
+
+
+def original_parse_command(commandstr):
+    if len(commandstr.split('|')) > 1:
+        return [original_parse_command(cmd) for cmd in commandstr.split('|')]
+    keys = {}
+    opts = []
+    command = None
+    for key in commandstr.strip().split(' '):
+        v = key.strip().split('=')
+        if len(v) > 1:
+            key, value = v[0], '='.join(v[1:])
+            keys[key] = original_unescape_str(value)
+        elif not v == ['']:
+            if v[0][0] == '-':
+                opts.append(v[0][1:])
+            else:
+                command = v[0]
+    d = {'keys': keys, 'opts': opts}
+    if command:
+        d['command'] = command
+    return d
+
+
+def read_reply(reply):
+    proto = TS3Proto()
+    proto._sockfile = StringIO(reply)
+    return sum(1 for row in proto.iter_response())
+
+
+def best_ms(func, *args):
+    return min(timeit.repeat(lambda: func(*args), number=1, repeat=REPEAT)) * 1000
+
+
+def main():
+    proto = TS3Proto()
+    print "%-32s %-10s %10s %10s %8s" % ("reply", "operation", "original", "current", "speedup")
+    for name in REPLIES:
+        reply = load_reply(name)
+        body = reply.split('\n', 1)[0]
+        raw_values = [token.partition('=')[2] for row in body.split('|') for token in row.split()]
+        values = [original_unescape_str(value) for value in raw_values]
+        timings = (
+            ("escape", best_ms(lambda: [original_escape_str(v) for v in values]),
+             best_ms(lambda: [TS3Proto._escape_str(v) for v in values])),
+            ("unescape", best_ms(lambda: [original_unescape_str(v) for v in raw_values]),
+             best_ms(lambda: [TS3Proto._unescape_str(v) for v in raw_values])),
+            ("parse", best_ms(original_parse_command, body), best_ms(proto.parse_command, body)),
+            ("stream", best_ms(original_parse_command, body), best_ms(read_reply, reply)),
+        )
+        for operation, original, current in timings:
+            print "%-32s %-10s %8.2fms %8.2fms %7.1fx" % (name, operation, original, current, original / current)
+
+
+if __name__ == '__main__':
+    main()
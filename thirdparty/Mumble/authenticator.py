@@ -41,15 +41,18 @@
 #            * daemon (when run as a daemon)
 #
 
+import os
 import sys
 import Ice
-import thread
+import hmac
+import time
 import urllib2
 import logging
 import ConfigParser
 
-from threading  import Timer
+from threading  import Timer, Lock, Semaphore
 from optparse   import OptionParser
+from collections import OrderedDict
 from logging    import (debug,
                         info,
                         warning,
@@ -81,10 +84,18 @@ default = {'database':(('lib', str, 'MySQLdb'),
                        ('password', str, 'password'),
                        ('prefix', str, ''),
                        ('host', str, '127.0.0.1'),
-                       ('port', int, 3306)),
+                       ('port', int, 3306),
+                       ('pool_size', int, 5),
+                       ('pool_check', int, 30),
+                       ('pool_idle', int, 300)),
                      
             'user':(('id_offset', int, 1000000000),
                     ('reject_on_error', x2bool, True)),
+
+            'cache':(('size', int, 1000),
+                     ('ttl', int, 60),
+                     ('credentials_ttl', int, 30),
+                     ('poll', int, 5)),
                     
             'ice':(('host', str, '127.0.0.1'),
                    ('port', int, 6502),
@@ -164,84 +175,313 @@ def entity_encode(string):
 class threadDbException(Exception): pass
 class threadDB(object):
     """
-    Small abstraction to handle database connections for multiple
-    threads
+    Small abstraction to handle a bounded pool of database connections
+    shared between the Ice dispatch threads
     """
     
-    db_connections = {}
+    # (connection, last used) tuples ready for checkout
+    idle = []
+    lock = Lock()
+    slots = None
+    stats = {'checkouts': 0, 'connects': 0, 'reaped': 0, 'wait_time': 0.0, 'max_wait': 0.0}
 
-    def connection(cls):
-        tid = thread.get_ident()
+    def connect(cls):
+        info('Connecting to database server (%s %s:%d %s)',
+             cfg.database.lib, cfg.database.host, cfg.database.port, cfg.database.name)
         try:
-            con = cls.db_connections[tid]
-        except:
-            info('Connecting to database server (%s %s:%d %s) for thread %d',
-                 cfg.database.lib, cfg.database.host, cfg.database.port, cfg.database.name, tid)
-            
-            try:
-                con = db.connect(host = cfg.database.host,
-                                   port = cfg.database.port,
-                                   user = cfg.database.user,
-                                   passwd = cfg.database.password,
-                                   db = cfg.database.name,
-                                   charset = 'utf8')
-                # Transactional engines like InnoDB initiate a transaction even
-                # on SELECTs-only. Thus, we auto-commit so smfauth gets recent data.
-                con.autocommit(True)
-            except db.Error, e:
-                error('Could not connect to database: %s', str(e))
-                raise threadDbException()
-            cls.db_connections[tid] = con
+            con = db.connect(host = cfg.database.host,
+                               port = cfg.database.port,
+                               user = cfg.database.user,
+                               passwd = cfg.database.password,
+                               db = cfg.database.name,
+                               charset = 'utf8')
+            # Transactional engines like InnoDB initiate a transaction even
+            # on SELECTs-only. Thus, we auto-commit so smfauth gets recent data.
+            con.autocommit(True)
+        except db.Error, e:
+            error('Could not connect to database: %s', str(e))
+            raise threadDbException()
+        cls.stats['connects'] += 1
         return con
-    connection = classmethod(connection)
-    
-    def cursor(cls):
-        return cls.connection().cursor()
-    cursor = classmethod(cursor)
-    
-    def execute(cls, *args, **kwargs):
-        if "threadDB__retry_execution__" in kwargs:
-            # Have a magic keyword so we can call ourselves while preventing
-            # an infinite loop
-            del kwargs["threadDB__retry_execution__"]
-            retry = False
-        else:
-            retry = True
-        
-        c = cls.cursor()
+    connect = classmethod(connect)
+
+    def checkout(cls):
+        with cls.lock:
+            if cls.slots is None:
+                cls.slots = Semaphore(cfg.database.pool_size)
+        start = time.time()
+        cls.slots.acquire()
+        waited = time.time() - start
         try:
-            c.execute(*args, **kwargs)
-        except db.OperationalError, e:
-            error('Database operational error %d: %s', e.args[0], e.args[1])
-            c.close()
-            cls.invalidate_connection()
-            if retry:
-                # Make sure we only retry once
-                info('Retrying database operation')
-                kwargs["threadDB__retry_execution__"] = True
-                c = cls.execute(*args, **kwargs)
+            with cls.lock:
+                cls.stats['checkouts'] += 1
+                cls.stats['wait_time'] += waited
+                cls.stats['max_wait'] = max(cls.stats['max_wait'], waited)
+                con, last_used = cls.idle.pop() if cls.idle else (None, 0)
+            if con and time.time() - last_used > cfg.database.pool_check:
+                # Health check connections that sat idle long enough for the server to drop them
+                try:
+                    con.ping()
+                except db.Error, e:
+                    debug('Dropping dead database connection: %s', str(e))
+                    cls.close(con)
+                    con = None
+            return con or cls.connect()
+        except:
+            cls.slots.release()
+            raise
+    checkout = classmethod(checkout)
+
+    def checkin(cls, con, discard = False):
+        try:
+            if discard:
+                cls.close(con)
             else:
+                with cls.lock:
+                    cls.idle.append((con, time.time()))
+        finally:
+            cls.slots.release()
+    checkin = classmethod(checkin)
+
+    def close(cls, con):
+        try:
+            con.close()
+        except db.Error:
+            pass
+    close = classmethod(close)
+
+    def execute(cls, *args, **kwargs):
+        """
+        Runs a statement and returns all result rows
+        """
+        for attempt in (1, 2):
+            con = cls.checkout()
+            failed = True
+            c = None
+            try:
+                c = con.cursor()
+                c.execute(*args, **kwargs)
+                # Fetch and close while the connection is still checked out,
+                # closing the cursor talks to the server and connections are
+                # not safe to share between threads
+                rows = c.fetchall()
+                c.close()
+                failed = False
+                return rows
+            except db.OperationalError, e:
+                error('Database operational error %d: %s', e.args[0], e.args[1])
+                if c:
+                    c.close()
+                if attempt == 1:
+                    # Make sure we only retry once
+                    info('Retrying database operation')
+                    continue
                 error('Database operation failed ultimately')
                 raise threadDbException()
-        return c
+            finally:
+                # Always give the slot back, a connection that raised is in an unknown state
+                cls.checkin(con, discard = failed)
     execute = classmethod(execute)
-    
-    def invalidate_connection(cls):
-        tid = thread.get_ident()
-        con = cls.db_connections.pop(tid, None)
-        if con:
-            debug('Invalidate connection to database for thread %d', tid)
-            con.close()
-            
-    invalidate_connection = classmethod(invalidate_connection)
+
+    def fetchone(cls, *args, **kwargs):
+        """
+        Runs a statement and returns its first row, or None if there is none
+        """
+        rows = cls.execute(*args, **kwargs)
+        return rows[0] if rows else None
+    fetchone = classmethod(fetchone)
+
+    def reap(cls):
+        """
+        Closes connections that have been idle longer than cfg.database.pool_idle
+        """
+        cutoff = time.time() - cfg.database.pool_idle
+        with cls.lock:
+            stale = [con for con, last_used in cls.idle if last_used < cutoff]
+            cls.idle = [(con, last_used) for con, last_used in cls.idle if last_used >= cutoff]
+            cls.stats['reaped'] += len(stale)
+        for con in stale:
+            debug('Closing idle database connection')
+            cls.close(con)
+    reap = classmethod(reap)
+
+    def get_stats(cls):
+        with cls.lock:
+            stats = dict(cls.stats)
+            stats['idle'] = len(cls.idle)
+        if stats['checkouts']:
+            stats['avg_wait'] = stats['wait_time'] / stats['checkouts']
+        return stats
+    get_stats = classmethod(get_stats)
     
     def disconnect(cls):
-        while cls.db_connections:
-            tid, con = cls.db_connections.popitem()
-            debug('Close database connection for thread %d', tid)
-            con.close()
+        with cls.lock:
+            idle, cls.idle = cls.idle, []
+        for con, last_used in idle:
+            debug('Close database connection')
+            cls.close(con)
     disconnect = classmethod(disconnect)
 
+# SQL statements with the table prefix applied, built once by build_statements
+statements = {}
+
+def build_statements(prefix):
+    table = prefix + 'services_mumbleuser'
+    return {'user_state': 'SELECT COUNT(*), MAX(updated), UTC_TIMESTAMP() FROM %s' % table,
+            'user_by_name': 'SELECT id, pwhash, groups FROM %s WHERE username = %%s' % table,
+            'user_by_id': 'SELECT username, id, pwhash, groups FROM %s WHERE id = %%s' % table,
+            'users_like': 'SELECT id, username FROM %s WHERE username LIKE %%s' % table}
+
+class userCache(object):
+    """
+    Bounded LRU cache of mumble user rows shared by all Ice threads.
+    Entries expire after cfg.cache.ttl seconds and the whole cache is
+    dropped as soon as the user table reports a change, which is polled
+    at most every cfg.cache.poll seconds.
+    Successful logins are remembered for cfg.cache.credentials_ttl seconds
+    under an HMAC of the password and the stored hash it was verified
+    against, never the password itself.
+    """
+
+    MISS = object()
+    # per process key for the password HMACs
+    secret = os.urandom(32)
+
+    lock = Lock()
+    # username -> (expires, (id, pwhash, groups) or None for unknown users)
+    entries = OrderedDict()
+    # id -> username for cached users
+    names = {}
+    # filter -> (expires, result) for getRegisteredUsers
+    lists = {}
+    # (username, password and pwhash hmac) -> (expires, id, groups, pwhash the password was verified against)
+    credentials = OrderedDict()
+    state = None
+    polled_at = None
+    next_poll = 0
+
+    def check_for_changes(cls):
+        now = time.time()
+        if now < cls.next_poll:
+            return
+        cls.next_poll = now + cfg.cache.poll
+        try:
+            count, updated, polled_at = threadDB.fetchone(statements['user_state'])
+        except threadDbException:
+            return
+        with cls.lock:
+            # updated only has second resolution, so a row touched in the same
+            # second as the previous poll could otherwise go unnoticed
+            touched = updated is not None and cls.polled_at is not None and updated >= cls.polled_at
+            if (count, updated) != cls.state or touched:
+                if cls.state is not None:
+                    debug('Mumble users changed, dropping %d cached users', len(cls.entries))
+                cls.entries.clear()
+                cls.names.clear()
+                cls.lists.clear()
+                cls.credentials.clear()
+                cls.state = (count, updated)
+            cls.polled_at = polled_at
+    check_for_changes = classmethod(check_for_changes)
+
+    def get(cls, name):
+        cls.check_for_changes()
+        with cls.lock:
+            entry = cls.entries.pop(name, None)
+            if entry is None:
+                return cls.MISS
+            if entry[0] < time.time():
+                if entry[1]:
+                    cls.names.pop(entry[1][0], None)
+                return cls.MISS
+            # re-insert to mark as most recently used
+            cls.entries[name] = entry
+            return entry[1]
+    get = classmethod(get)
+
+    def get_name(cls, id):
+        with cls.lock:
+            name = cls.names.get(id)
+        if name is None:
+            return cls.MISS
+        row = cls.get(name)
+        if not row or row is cls.MISS or row[0] != id:
+            return cls.MISS
+        return name
+    get_name = classmethod(get_name)
+
+    def put(cls, name, row):
+        with cls.lock:
+            # logins verified against a different hash are no longer valid
+            for key, entry in cls.credentials.items():
+                if key[0] == name and (not row or entry[3] != row[1]):
+                    del cls.credentials[key]
+            cls.entries.pop(name, None)
+            cls.entries[name] = (time.time() + cfg.cache.ttl, row)
+            if row:
+                cls.names[row[0]] = name
+            while len(cls.entries) > cfg.cache.size:
+                evicted, (expires, evicted_row) = cls.entries.popitem(last = False)
+                if evicted_row and cls.names.get(evicted_row[0]) == evicted:
+                    del cls.names[evicted_row[0]]
+    put = classmethod(put)
+
+    def get_list(cls, filter):
+        cls.check_for_changes()
+        with cls.lock:
+            entry = cls.lists.get(filter)
+            if entry is None or entry[0] < time.time():
+                return cls.MISS
+            return entry[1]
+    get_list = classmethod(get_list)
+
+    def put_list(cls, filter, result):
+        with cls.lock:
+            if len(cls.lists) >= cfg.cache.size:
+                cls.lists.clear()
+            cls.lists[filter] = (time.time() + cfg.cache.ttl, result)
+    put_list = classmethod(put_list)
+
+    def credential_key(cls, name, pw, pwhash):
+        if isinstance(pw, unicode):
+            pw = pw.encode('utf-8')
+        # the stored hash is part of the key, so a rotated password never matches an old entry
+        return (name, hmac.new(cls.secret, '%s:%s' % (pwhash, pw), sha1).hexdigest())
+    credential_key = classmethod(credential_key)
+
+    def get_credentials(cls, name, pw, pwhash):
+        """
+        Returns (id, groups) if this password was recently verified for name
+        against the currently stored pwhash
+        """
+        key = cls.credential_key(name, pw, pwhash)
+        with cls.lock:
+            entry = cls.credentials.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            cls.credentials[key] = entry
+            return entry[1], entry[2]
+    get_credentials = classmethod(get_credentials)
+
+    def put_credentials(cls, name, pw, id, groups, pwhash):
+        key = cls.credential_key(name, pw, pwhash)
+        with cls.lock:
+            cls.credentials.pop(key, None)
+            cls.credentials[key] = (time.time() + cfg.cache.credentials_ttl, id, groups, pwhash)
+            while len(cls.credentials) > cfg.cache.size:
+                cls.credentials.popitem(last = False)
+    put_credentials = classmethod(put_credentials)
+
+def fetch_user(name, cached = True):
+    """
+    Returns the (id, pwhash, groups) row for a username, or None if unknown
+    """
+    row = userCache.get(name) if cached else userCache.MISS
+    if row is userCache.MISS:
+        row = threadDB.fetchone(statements['user_by_name'], [name])
+        userCache.put(name, row)
+    return row
+
 def do_main_program():
     #
     #--- Authenticator implementation
@@ -254,6 +494,8 @@ def do_main_program():
         slicedir = ['-I' + slicedir]
     Ice.loadSlice('', slicedir + [cfg.ice.slice])
     import Murmur
+
+    statements.update(build_statements(cfg.database.prefix))
     
     class allianceauthauthenticatorApp(Ice.Application):
         def run(self, args):
@@ -359,6 +601,9 @@ def do_main_program():
                 debug(str(e))
                 self.failedWatch = True
 
+            threadDB.reap()
+            debug('Database pool stats: %s', threadDB.get_stats())
+
             # Renew the timer
             self.watchdog = Timer(cfg.ice.watchdog, self.checkConnection)
             self.watchdog.start()
@@ -485,15 +730,14 @@ def do_main_program():
             if name == 'SuperUser':
                 debug('Forced fall through for SuperUser')
                 return (FALL_THROUGH, None, None)
-            
+
+            # Always read the row, the cached rows and logins may still hold a
+            # password hash that was rotated since the last change poll
             try:
-                sql = 'SELECT id, pwhash, groups FROM %sservices_mumbleuser WHERE username = %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [name])
+                res = fetch_user(name, cached = False)
             except threadDbException:
                 return (FALL_THROUGH, None, None)
             
-            res = cur.fetchone()
-            cur.close()
             if not res:
                 info('Fall through for unknown user "%s"', name)
                 return (FALL_THROUGH, None, None)
@@ -504,8 +748,14 @@ def do_main_program():
               groups = ugroups.split(',')
             else:
               groups = []
+
+            # the row was just read, so its groups are newer than the cached ones
+            if userCache.get_credentials(name, pw, upwhash):
+                info('User authenticated from cache: "%s" (%d)', name, uid + cfg.user.id_offset)
+                return (uid + cfg.user.id_offset, entity_decode(name), groups)
             
             if allianceauth_check_hash(pw, upwhash):
+                userCache.put_credentials(name, pw, uid, groups, upwhash)
                 info('User authenticated: "%s" (%d)', name, uid + cfg.user.id_offset)
                 debug('Group memberships: %s', str(groups))
                 return (uid + cfg.user.id_offset, entity_decode(name), groups)
@@ -537,13 +787,10 @@ def do_main_program():
                 return FALL_THROUGH
             
             try:
-                sql = 'SELECT id FROM %sservices_mumbleuser WHERE username = %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [name])
+                res = fetch_user(name)
             except threadDbException:
                 return FALL_THROUGH
             
-            res = cur.fetchone()
-            cur.close()
             if not res:
                 debug('nameToId %s -> ?', name)
                 return FALL_THROUGH
@@ -564,15 +811,18 @@ def do_main_program():
                 return FALL_THROUGH 
             bbid = id - cfg.user.id_offset
             
-            # Fetch the user from the database
-            try:
-                sql = 'SELECT username FROM %sservices_mumbleuser WHERE id = %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [bbid])
-            except threadDbException:
-                return FALL_THROUGH
-            
-            res = cur.fetchone()
-            cur.close()
+            # Fetch the user from the cache or the database
+            name = userCache.get_name(bbid)
+            if name is not userCache.MISS:
+                res = (name,)
+            else:
+                try:
+                    res = threadDB.fetchone(statements['user_by_id'], [bbid])
+                except threadDbException:
+                    return FALL_THROUGH
+
+                if res:
+                    userCache.put(res[0], res[1:])
             if res:
                 if res[0] == 'SuperUser':
                     debug('idToName %d -> "SuperUser" catched')
@@ -631,14 +881,14 @@ def do_main_program():
             if not filter:
                 filter = '%'
             
-            try:
-                sql = 'SELECT id, username FROM %sservices_mumbleuser WHERE username LIKE %%s' % cfg.database.prefix
-                cur = threadDB.execute(sql, [filter])
-            except threadDbException:
-                return {}
-    
-            res = cur.fetchall()
-            cur.close()
+            res = userCache.get_list(filter)
+            if res is userCache.MISS:
+                try:
+                    res = threadDB.execute(statements['users_like'], [filter])
+                except threadDbException:
+                    return {}
+
+                userCache.put_list(filter, res)
             if not res:
                 debug('getRegisteredUsers -> empty list for filter "%s"', filter)
                 return {}
@@ -5,6 +5,9 @@ from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
 from django.contrib.auth.models import Permission
 from django.conf import settings
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 
 import logging
 
@@ -30,40 +33,78 @@ def bootstrap_permissions():
     Permission.objects.get_or_create(codename="logging_notifications", content_type=ct, name="logging_notifications")
     Group.objects.get_or_create(name=settings.DEFAULT_AUTH_GROUP)
     Group.objects.get_or_create(name=settings.DEFAULT_BLUE_GROUP)
+    load_permission_registry()
     logger.info("Bootstrapped permissions for auth and created default groups.")
 
 
+# auth permissions on the User content type by codename, shared by the process
+permission_registry = {}
+
+
+def load_permission_registry():
+    ct = ContentType.objects.get_for_model(User)
+    permissions = dict((p.codename, p) for p in Permission.objects.filter(content_type=ct))
+    permission_registry.clear()
+    permission_registry.update(permissions)
+    logger.debug("Loaded %s permissions into registry." % len(permissions))
+
+
+def get_permission(codename):
+    if not permission_registry:
+        load_permission_registry()
+    if codename not in permission_registry:
+        ct = ContentType.objects.get_for_model(User)
+        stored_permission, created = Permission.objects.get_or_create(codename=codename,
+                                                                      content_type=ct, name=codename)
+        permission_registry[codename] = stored_permission
+    return permission_registry[codename]
+
+
+@receiver(post_save, sender=Permission)
+def post_save_permission(sender, instance, *args, **kwargs):
+    for codename, permission in permission_registry.items():
+        if permission.pk == instance.pk:
+            del permission_registry[codename]
+    if permission_registry and instance.content_type_id == ContentType.objects.get_for_model(User).pk:
+        permission_registry[instance.codename] = instance
+
+
+@receiver(post_delete, sender=Permission)
+def post_delete_permission(sender, instance, *args, **kwargs):
+    for codename, permission in permission_registry.items():
+        if permission.pk == instance.pk:
+            del permission_registry[codename]
+
+
+def clear_permission_cache(user):
+    # ModelBackend caches permissions on the user instance
+    for attr in ('_perm_cache', '_user_perm_cache', '_group_perm_cache'):
+        if hasattr(user, attr):
+            delattr(user, attr)
+
+
 def add_member_permission(user, permission):
     logger.debug("Adding permission %s to member %s" % (permission, user))
-    ct = ContentType.objects.get_for_model(User)
-    stored_permission, created = Permission.objects.get_or_create(codename=permission,
-                                                                  content_type=ct, name=permission)
-    user = User.objects.get(username=user.username)
+    stored_permission = get_permission(permission)
     user.user_permissions.add(stored_permission)
+    clear_permission_cache(user)
     logger.info("Added permission %s to user %s" % (permission, user))
-    user.save()
 
 
 def remove_member_permission(user, permission):
     logger.debug("Removing permission %s from member %s" % (permission, user))
-    ct = ContentType.objects.get_for_model(User)
-    stored_permission, created = Permission.objects.get_or_create(codename=permission,
-                                                                  content_type=ct, name=permission)
-
-    user = User.objects.get(username=user.username)
+    stored_permission = get_permission(permission)
 
     if user.has_perm('auth.' + permission):
         user.user_permissions.remove(stored_permission)
-        user.save()
+        clear_permission_cache(user)
         logger.info("Removed permission %s from member %s" % (permission, user))
     else:
         logger.warn("Attempting to remove permission user %s does not have: %s" % (user, permission))
 
 
 def check_if_user_has_permission(user, permission):
-    ct = ContentType.objects.get_for_model(User)
-    stored_permission, created = Permission.objects.get_or_create(codename=permission,
-                                                                  content_type=ct, name=permission)
+    get_permission(permission)
     return user.has_perm('auth.' + permission)
 
 